@@ -10,6 +10,10 @@ from src.routers import heatmap
 from src.utils.logger import logger
 from src.routers import admin
 from src.routers import copilot
+from src.ml.planner_pool import planner_pool
+from src.ml.fleet_tracker import fleet_tracker
+from src.ml.planning_scheduler import planning_scheduler
+from src.ml.data import async_client
 
 
 def create_application() -> FastAPI:
@@ -46,9 +50,21 @@ app.add_middleware(
 init_db(app)
 
 
+@app.on_event("startup")
+async def startup_event():
+    # Periodic write-behind of driver statuses to the earners table
+    fleet_tracker.start()
+    # Keep every city's plan precomputed in the background
+    planning_scheduler.start()
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down...")
+    await planning_scheduler.stop()
+    await fleet_tracker.stop()
+    planner_pool.shutdown()
+    await async_client.close()
 
 
 @app.get("/ping")
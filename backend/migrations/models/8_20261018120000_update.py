@@ -0,0 +1,62 @@
+import json
+
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+from tortoise import BaseDBAsyncClient
+
+# Keep in sync with ZONE_SIMPLIFY_TOLERANCE's default (src/ml/zone_geometry.py)
+SIMPLIFY_TOLERANCE = 0.0005
+
+
+def _decode_json(value):
+    # Zones were sometimes saved as an already-serialized JSON string
+    while isinstance(value, (str, bytes)):
+        value = json.loads(value)
+    return value
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    await db.execute_script("""
+        CREATE TABLE IF NOT EXISTS "city_zones" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "zone_index" INT NOT NULL,
+    "geometry" BYTEA NOT NULL,
+    "simplified" BYTEA NOT NULL,
+    "city_id" INT NOT NULL REFERENCES "cities" ("city_id") ON DELETE CASCADE,
+    CONSTRAINT "uid_city_zones_city_id_6b1f0e" UNIQUE ("city_id", "zone_index")
+);""")
+
+    # ZoneFormat JSON -> one WKB MultiPolygon (plus simplified variant) per zone
+    _, cities = await db.execute_query('SELECT "city_id", "zones" FROM "cities" WHERE "zones" IS NOT NULL')
+    for city in cities:
+        for zone_index, zone in enumerate(_decode_json(city["zones"]) or []):
+            geometry = MultiPolygon([Polygon(shape["shell"], holes=shape["holes"]) for shape in zone])
+            simplified = shapely.simplify(geometry, SIMPLIFY_TOLERANCE, preserve_topology=True)
+            await db.execute_query(
+                'INSERT INTO "city_zones" ("city_id", "zone_index", "geometry", "simplified") VALUES ($1, $2, $3, $4)',
+                [city["city_id"], zone_index, shapely.to_wkb(geometry), shapely.to_wkb(simplified)])
+
+    return """
+        ALTER TABLE "cities" DROP COLUMN "zones";"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    await db.execute_script("""
+        ALTER TABLE "cities" ADD "zones" JSONB;""")
+
+    _, rows = await db.execute_query(
+        'SELECT "city_id", "geometry" FROM "city_zones" ORDER BY "city_id", "zone_index"')
+    zones = {}
+    for row in rows:
+        zones.setdefault(row["city_id"], []).append([
+            {
+                "shell": list(polygon.exterior.coords),
+                "holes": [list(hole.coords) for hole in polygon.interiors]
+            } for polygon in shapely.from_wkb(bytes(row["geometry"])).geoms
+        ])
+    for city_id, city_zones in zones.items():
+        await db.execute_query('UPDATE "cities" SET "zones" = $1 WHERE "city_id" = $2',
+                               [json.dumps(city_zones), city_id])
+
+    return """
+        DROP TABLE IF EXISTS "city_zones";"""
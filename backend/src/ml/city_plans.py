@@ -0,0 +1,294 @@
+import asyncio
+import os
+import random
+import time as timing
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, List, Optional, Tuple
+from shapely.geometry import Polygon
+from src.ml.fleet_tracker import FleetSnapshot, apply_fleet_snapshot, fleet_tracker
+from src.ml.planner_pool import CityPlanningData, PlanRequest, PlanResult, planner_pool
+from src.ml.planners import STEP_MINUTES, DEFAULT_BEAM_WIDTH, SSSPlanner, planner_options
+from src.ml.planning_context import PlanningContext, ActionLimits, DEFAULT_MEMO_MAX_ENTRIES, DEFAULT_MEMO_MAX_BYTES
+from src.ml.sss import build_fleet_state, precompute_zone_centroids, precompute_zone_distances
+from src.ml.zone_geometry import load_city_zones
+from src.models import Cities, Earners
+from src.utils.logger import logger
+
+# Plans kept in memory (all cities, ticks and settings)
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", 256))
+
+
+def plan_tick(time: datetime) -> datetime:
+    """Start of the STEP_MINUTES planning tick containing time"""
+    return time.replace(minute=time.minute - time.minute % STEP_MINUTES, second=0, microsecond=0)
+
+
+@dataclass(frozen=True)
+class PlanSettings:
+    """Search parameters of a city plan (defaults of /state-space-search-optimized)"""
+    max_depth: int = 3
+    max_simultaneous_actions: int = 2
+    max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES
+    max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES
+    workers: int = 1
+    planner: str = SSSPlanner.name
+    max_nodes: Optional[int] = None
+    beam_width: int = DEFAULT_BEAM_WIDTH
+    max_children: int = ActionLimits.max_children
+    max_batches: int = ActionLimits.max_batches
+    warm_start: bool = True
+    deadline_ms: Optional[int] = None  # iterative deepening budget, counted from the start of the plan's computation
+
+    def plan_request(self, fleet, time: datetime, deadline: Optional[float] = None) -> PlanRequest:
+        return PlanRequest(
+            fleet=fleet,
+            time=time,
+            max_depth=self.max_depth,
+            max_simultaneous_actions=self.max_simultaneous_actions,
+            iterative=self.max_nodes is not None or self.deadline_ms is not None,
+            deadline=deadline,
+            workers=self.workers,
+            max_memo_entries=self.max_memo_entries,
+            max_memo_bytes=self.max_memo_bytes,
+            planner=self.planner,
+            planner_options=planner_options(self.planner, self.beam_width),
+            max_nodes=self.max_nodes,
+            action_limits=ActionLimits(
+                max_children=self.max_children, max_batches=self.max_batches),
+            warm_start=self.warm_start,
+        )
+
+
+@dataclass
+class CityPlan:
+    """A city's plan for one tick and fleet snapshot"""
+    city_id: int
+    tick: datetime
+    fleet_version: int
+    settings: PlanSettings
+    result: PlanResult
+    drivers_considered: int
+    computed_at: datetime
+    compute_seconds: float  # city data preparation plus search
+    data_generation: int = 0  # city data generation the plan was searched with (see CityPlanCache.invalidate)
+    # driver_id -> (batch index, action) of the driver's moves, built on first use
+    _driver_actions: Optional[Dict[str, List[tuple]]] = field(default=None, repr=False)
+
+    def actions_for_driver(self, driver_id: str) -> List[tuple]:
+        """(batch index, action) of every move of the driver, in plan order"""
+        if self._driver_actions is None:
+            self._driver_actions = {}
+            for index, batch in enumerate(self.result.optimal_action_batches):
+                for action in batch.actions:
+                    self._driver_actions.setdefault(action.driver_id, []).append((index, action))
+        return self._driver_actions.get(driver_id, [])
+
+
+async def ensure_driver_locations(drivers, ctx: PlanningContext):
+    """Place drivers without a location at a random zone's centroid (and save it)"""
+    for driver in drivers:
+        if driver.latitude == 0 or driver.longitude == 0:
+            # get random location within a random zone
+            random_zone = random.choice(ctx.geometry.zones)
+            random_shape = random.choice(random_zone.shapes)
+            random_point = Polygon(random_shape.exterior).centroid
+            driver.latitude = random_point.y
+            driver.longitude = random_point.x
+
+            # update driver location in db
+            await Earners.filter(earner_id=driver.earner_id).update(
+                latitude=driver.latitude, longitude=driver.longitude)
+
+
+async def compute_city_plan(city_id: int, tick: datetime, snapshot: FleetSnapshot,
+                            settings: PlanSettings) -> Optional[CityPlan]:
+    """
+    Build the city's planning inputs and search a plan for the tick
+
+    snapshot holds the city's driver statuses at the tick. Returns None if
+    the city doesn't exist.
+    """
+    start = timing.time()
+    deadline_start = timing.monotonic()
+    city = await Cities.filter(city_id=city_id).first()
+    if not city:
+        return None
+
+    zones = await load_city_zones(city_id)
+
+    # Request-scoped memo, counters, densities and zone caches
+    ctx = PlanningContext.for_city(city, zones, settings.max_memo_entries, settings.max_memo_bytes)
+    ctx.set_deadline(settings.deadline_ms, deadline_start)
+    # Building the compiled zone geometry on a cache miss takes a while
+    await asyncio.to_thread(precompute_zone_centroids, ctx)
+
+    drivers = await Earners.filter(home_city_id=city_id, earner_type="driver").all()
+
+    await ensure_driver_locations(drivers, ctx)
+
+    apply_fleet_snapshot(drivers, snapshot)
+
+    await precompute_zone_distances(ctx, tick)
+
+    fleet = build_fleet_state(drivers, ctx)
+
+    result = await planner_pool.plan(city_id, CityPlanningData.from_context(ctx),
+                                     settings.plan_request(fleet, tick, ctx.deadline))
+
+    return CityPlan(
+        city_id=city_id,
+        tick=tick,
+        fleet_version=snapshot.version,
+        settings=settings,
+        result=result,
+        drivers_considered=len(drivers),
+        computed_at=datetime.now(),
+        compute_seconds=timing.time() - start,
+    )
+
+
+class CityPlanCache:
+    """
+    Plans shared by every caller within a planning tick
+
+    Plans are keyed by (city_id, tick, fleet snapshot version, city data
+    generation, settings) and searched at the start of their tick, so all
+    requests for the same city in the same tick and fleet state get the same
+    plan. Concurrent requests for a plan that is still being searched wait
+    for that search instead of starting their own. Writes to a city's zones
+    or densities call invalidate(), which starts a new data generation.
+    """
+
+    def __init__(self, max_entries: int = PLAN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._plans: "OrderedDict[Hashable, CityPlan]" = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._latest: Dict[int, CityPlan] = {}  # city_id -> most recently computed plan
+        self._generations: Dict[int, int] = {}  # city_id -> data generation
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def current_snapshot(self, city_id: int, time: datetime) -> Tuple[datetime, FleetSnapshot]:
+        """
+        Returns (tick, city's fleet snapshot at the tick) for time's tick
+
+        The tracker is advanced to the tick start, checked and advanced under
+        its lock. If another request already moved it to a later moment of
+        the same tick, its live snapshot is used as is, so the tick keeps one
+        fleet version and its plan stays cached. Only ticks the tracker has
+        left behind get a snapshot rebuilt for their start.
+        """
+        tick = plan_tick(time)
+        return tick, await fleet_tracker.snapshot_at(
+            city_id, tick, live_until=tick + timedelta(minutes=STEP_MINUTES))
+
+    async def get(self, city_id: int, time: datetime, settings: PlanSettings = PlanSettings()) -> Tuple[Optional[CityPlan], bool]:
+        """
+        The city's plan for time's tick, searching it if needed
+
+        Returns (plan, cached): plan is None if the city doesn't exist, and
+        cached tells whether the plan was already available or being searched.
+        """
+        tick, snapshot = await self.current_snapshot(city_id, time)
+        key = self._key(city_id, tick, snapshot.version, settings)
+
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan, True
+
+        task = self._in_flight.get(key)
+        cached = task is not None
+        if cached:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._compute(key, snapshot))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # One caller giving up doesn't cancel the search for the others
+        return await asyncio.shield(task), cached
+
+    def _key(self, city_id: int, tick: datetime, fleet_version: int, settings: PlanSettings) -> Hashable:
+        return city_id, tick, fleet_version, self._generations.get(city_id, 0), settings
+
+    async def _compute(self, key, snapshot: FleetSnapshot) -> Optional[CityPlan]:
+        city_id, tick, fleet_version, generation, settings = key
+        plan = await compute_city_plan(city_id, tick, snapshot, settings)
+        if plan is not None:
+            plan.data_generation = generation
+            self.put(plan)
+            logger.info(
+                f"Planned city {city_id} for tick {tick:%H:%M} (fleet version {fleet_version}) in {plan.compute_seconds:.2f}s")
+        return plan
+
+    def put(self, plan: CityPlan):
+        if plan.data_generation != self._generations.get(plan.city_id, 0):
+            # Searched with city data that has changed since
+            return
+        self._plans[(plan.city_id, plan.tick, plan.fleet_version, plan.data_generation, plan.settings)] = plan
+        latest = self._latest.get(plan.city_id)
+        if latest is None or (plan.tick, plan.computed_at) >= (latest.tick, latest.computed_at):
+            self._latest[plan.city_id] = plan
+        while len(self._plans) > self.max_entries:
+            self._plans.popitem(last=False)
+
+    def contains(self, city_id: int, tick: datetime, fleet_version: int, settings: PlanSettings) -> bool:
+        """Whether the plan is cached or being searched"""
+        key = self._key(city_id, tick, fleet_version, settings)
+        return key in self._plans or key in self._in_flight
+
+    def latest(self, city_id: int) -> Optional[CityPlan]:
+        """Most recent plan computed for the city (any settings)"""
+        return self._latest.get(city_id)
+
+    async def get_current(self, city_id: int, time: datetime, compute: bool = True) -> Tuple[Optional[CityPlan], bool]:
+        """
+        The city's plan for time's tick and current fleet, with whatever
+        settings it was computed; searched with the default settings if
+        there is none yet. With compute=False, the latest plan is returned
+        instead (possibly for an earlier tick, or None).
+        """
+        tick, snapshot = await self.current_snapshot(city_id, time)
+        latest = self._latest.get(city_id)
+        if latest is not None and latest.tick == tick and latest.fleet_version == snapshot.version:
+            self.hits += 1
+            return latest, True
+        if not compute:
+            return latest, latest is not None
+        return await self.get(city_id, time)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self._plans),
+            "in_flight": len(self._in_flight),
+        }
+
+    def invalidate(self, city_id: int):
+        """
+        The city's zones or densities changed: drop its plans
+
+        Searches still running with the old data finish for their waiting
+        callers, but their plans aren't cached, and the next request (or
+        scheduler round) searches again.
+        """
+        self._generations[city_id] = self._generations.get(city_id, 0) + 1
+        for key in [key for key in self._plans if key[0] == city_id]:
+            del self._plans[key]
+        self._latest.pop(city_id, None)
+
+    def clear(self):
+        self._plans.clear()
+        self._latest.clear()
+
+
+# Global plan cache instance
+city_plan_cache = CityPlanCache()
@@ -1,14 +1,17 @@
+import asyncio
 from datetime import datetime, timedelta
-from shapely import GeometryCollection, MultiPolygon
+from shapely import GeometryCollection, MultiPolygon, STRtree
+from src.ml.travel_time_store import travel_time_store
 from src.utils.logger import logger
 import traveltimepy as tt
 from traveltimepy.requests.common import Coordinates, Location
 from traveltimepy.requests.time_filter import TimeFilterDepartureSearch, Driving
 from traveltimepy.responses.time_map import Shape
 import os
-import json
 from dotenv import load_dotenv
 from shapely.geometry import Point, Polygon
+import numpy as np
+import shapely
 
 load_dotenv(os.path.join(os.getcwd(), ".env"))
 
@@ -16,25 +19,16 @@ app_id = os.getenv("TRAVELTIME_APP_ID")
 api_key = os.getenv("TRAVELTIME_API_KEY")
 
 client = tt.Client(app_id, api_key)
+async_client = tt.AsyncClient(app_id, api_key, max_rpm=int(os.getenv("TRAVELTIME_MAX_RPM", 60)))
 
-# Cache management
-CACHE_FILE = "travelCache.json"
+# Destinations per time_filter search (one origin to many destinations)
+TRAVEL_MATRIX_BATCH_SIZE = int(os.getenv("TRAVEL_MATRIX_BATCH_SIZE", 100))
 
+# time_filter calls in flight at once while building a travel time matrix
+TRAVEL_MATRIX_CONCURRENCY = int(os.getenv("TRAVEL_MATRIX_CONCURRENCY", 8))
 
-def load_travel_cache():
-    try:
-        with open(CACHE_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-
-def save_travel_cache(cache):
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(cache, f, indent=2)
-
-
-travel_cache = load_travel_cache()
+MAX_TRAVEL_TIME = 3600  # 1 hour max travel time in seconds
+NO_ROUTE_TRAVEL_TIME = 360000  # used when there is no route within MAX_TRAVEL_TIME
 
 # Geographical boundary
 CoordinatePolygon = list[tuple[float, float]]
@@ -92,6 +86,53 @@ def point_near_zone(point, zone: ZoneFormat, distance: float = 0.0005):
     return False
 
 
+def points_near_zones(lats, lngs, shapes, shape_zones, zone_bounds, distance: float = 0.0005,
+                      tree: STRtree = None) -> np.ndarray:
+    """
+    Vectorized point_near_zone for many points and zones at once
+
+    Args:
+        lats, lngs: Coordinates of the points
+        shapes: Polygons of all zones
+        shape_zones: Zone id of each shape
+        zone_bounds: (min_x, min_y, max_x, max_y) of each zone; a point only
+            matches zones whose bounding box contains it
+        tree: STRtree over shapes (built if not given)
+
+    Returns:
+        The lowest zone id each point is in or within distance of, -1 if none
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    shapes = np.asarray(shapes, dtype=object)
+    shape_zones = np.asarray(shape_zones)
+    zone_bounds = np.asarray(zone_bounds, dtype=float).reshape(-1, 4)
+    zone_ids = np.full(len(lats), -1, dtype=np.int32)
+    if not len(lats) or not len(shapes):
+        return zone_ids
+
+    # Candidate (point, shape) pairs from the R-tree, then the exact test
+    tree = tree if tree is not None else STRtree(shapes)
+    points = shapely.points(lngs, lats)  # lng, lat for Shapely
+    point_index, shape_index = tree.query(points, predicate="dwithin", distance=distance)
+    pair_zones = shape_zones[shape_index]
+
+    # Quick bounding box check (lng=x, lat=y)
+    x, y, bounds = lngs[point_index], lats[point_index], zone_bounds[pair_zones]
+    near = (bounds[:, 0] <= x) & (x <= bounds[:, 2]) & (bounds[:, 1] <= y) & (y <= bounds[:, 3])
+    point_index, shape_index, pair_zones = point_index[near], shape_index[near], pair_zones[near]
+
+    # dwithin includes shapes at exactly distance, point_near_zone doesn't
+    near = shapely.contains_xy(shapes[shape_index], lngs[point_index], lats[point_index])
+    near[~near] = shapely.distance(shapes[shape_index[~near]], points[point_index[~near]]) < distance
+
+    first = np.full(len(lats), len(zone_bounds), dtype=np.int64)
+    np.minimum.at(first, point_index[near], pair_zones[near])
+    found = first < len(zone_bounds)
+    zone_ids[found] = first[found]
+    return zone_ids
+
+
 def cut_zone_with_others(zone: ZoneFormat, others: list[ZoneFormat]):
     # Cut others from each shape
     for i, shape in enumerate(zone):
@@ -198,34 +239,26 @@ def get_zone(lat, lng, seconds):
     return zone
 
 
-def get_travel_time(origin, destination, start_time):
-    # Create cache key with rounded coordinates to improve cache hit rate
-    cache_key = f"{round(origin[0], 6)},{round(origin[1], 6)}-{round(destination[0], 6)},{round(destination[1], 6)}"
-
-    # Check cache first
-    if cache_key in travel_cache:
-        logger.info(f"Cache hit for {cache_key}")
-        return travel_cache[cache_key]
-
-    logger.info(f"Cache miss for {cache_key}, making API call")
-
-    response = client.time_filter(
+async def fetch_travel_times(origin, destinations, start_time) -> list[int]:
+    """Travel times (seconds) from origin to each destination, in one time_filter call"""
+    response = await async_client.time_filter(
         locations=[
             Location(
                 id="origin",
                 coords=Coordinates(lat=origin[0], lng=origin[1])
-            ),
+            )
+        ] + [
             Location(
-                id="destination",
+                id=str(index),
                 coords=Coordinates(lat=destination[0], lng=destination[1])
-            )
+            ) for index, destination in enumerate(destinations)
         ],
         departure_searches=[
             TimeFilterDepartureSearch(
                 id="1",
                 departure_location_id="origin",
-                arrival_location_ids=["destination"],
-                travel_time=3600,  # 1 hour max travel time in seconds
+                arrival_location_ids=[str(index) for index in range(len(destinations))],
+                travel_time=MAX_TRAVEL_TIME,
                 departure_time=start_time,
                 transportation=Driving(),
                 properties=["travel_time"]
@@ -234,26 +267,58 @@ def get_travel_time(origin, destination, start_time):
         arrival_searches=[]
     )
 
-    logger.info(f"Travel time response: {response}")
-
-    if response.results and response.results[0].locations:
-        travel_time = response.results[0].locations[0].properties[0].travel_time
-        logger.info(f"Travel time: {travel_time} seconds")
-
-        # Cache the result
-        travel_cache[cache_key] = travel_time
-        save_travel_cache(travel_cache)
-
-        return travel_time
-    else:
-        logger.warning("No travel time found")
-        default_time = 360000  # Return max travel time if no result
-
-        # Cache the default result to avoid repeated failed API calls
-        travel_cache[cache_key] = default_time
-        save_travel_cache(travel_cache)
-
-        return default_time
+    # Unreachable destinations are left out of the results
+    travel_times = [NO_ROUTE_TRAVEL_TIME] * len(destinations)
+    for result in response.results:
+        for location in result.locations:
+            travel_times[int(location.id)] = location.properties[0].travel_time
+    return travel_times
+
+
+async def build_travel_time_matrix(points, start_time, batch_size: int = TRAVEL_MATRIX_BATCH_SIZE,
+                                   concurrency: int = TRAVEL_MATRIX_CONCURRENCY) -> np.ndarray:
+    """
+    Travel times (seconds) between every ordered pair of points (lat, lng)
+
+    Pairs with a fresh entry in the travel time store for start_time's
+    bucket aren't requested again. The others are fetched with one
+    many-to-many time_filter call per origin and up to batch_size
+    destinations, at most concurrency calls at a time, and each call's
+    results are put in the store as they arrive. The diagonal is 0.
+    """
+    matrix = np.zeros((len(points), len(points)), dtype=np.int64)
+    pairs = [(i, j) for i in range(len(points)) for j in range(len(points)) if i != j]
+    # The store is SQLite; a write-locked database must not stall the event loop
+    stored = await asyncio.to_thread(
+        travel_time_store.get_many, [(points[i], points[j]) for i, j in pairs], start_time)
+    missing: dict[int, list[int]] = {}
+    for index, (i, j) in enumerate(pairs):
+        if index in stored:
+            matrix[i, j] = stored[index]
+        else:
+            missing.setdefault(i, []).append(j)
+
+    if not missing:
+        return matrix
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch_batch(i: int, destinations: list[int]):
+        async with semaphore:
+            travel_times = await fetch_travel_times(points[i], [points[j] for j in destinations], start_time)
+        matrix[i, destinations] = travel_times
+        await asyncio.to_thread(
+            travel_time_store.put_many,
+            [(points[i], points[j], travel_time) for j, travel_time in zip(destinations, travel_times)], start_time)
+
+    batches = [(i, destinations[start:start + batch_size])
+               for i, destinations in missing.items()
+               for start in range(0, len(destinations), batch_size)]
+    logger.info(
+        f"Fetching {sum(len(destinations) for destinations in missing.values())} travel times in {len(batches)} requests")
+    await asyncio.gather(*[fetch_batch(i, destinations) for i, destinations in batches])
+
+    return matrix
 
 
 def test():
@@ -0,0 +1,281 @@
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence
+import numpy as np
+
+# Status codes stored in FleetState.status
+STATUS_ONLINE = 0
+STATUS_ENGAGED = 1
+STATUS_OFFLINE = 2
+STATUS_OTHER = 3
+
+STATUS_CODES = {
+    "online": STATUS_ONLINE,
+    "engaged": STATUS_ENGAGED,
+    "offline": STATUS_OFFLINE,
+}
+
+# Zone sentinels stored in FleetState.zone / FleetState.destination
+NO_ZONE = -1  # driver is outside every zone / has no destination
+UNKNOWN_ZONE = -2  # driver has a destination we can't map to a zone id
+
+
+def parse_zone_id(value) -> int:
+    """Convert an Earners.destination_zone value (nullable string) to a zone id"""
+    if value is None:
+        return NO_ZONE
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return UNKNOWN_ZONE
+
+
+# Zobrist hashing over a canonical, count-based view of the fleet: idle
+# drivers are interchangeable for the evaluation and the action generator,
+# so a state is identified by the number of idle drivers per current zone,
+# en-route drivers per destination zone and engaged drivers per zone, not
+# by which driver is where. Every (kind, zone, count) gets a pseudo-random
+# 64-bit key (derived with splitmix64 instead of being stored in a table)
+# and a state's hash is the XOR of its keys, so moving one driver only
+# needs a few XORs.
+_MASK64 = (1 << 64) - 1
+_FIELD_IDLE = 0
+_FIELD_EN_ROUTE = 1
+_FIELD_ENGAGED = 2
+
+
+def _mix(z: int) -> int:
+    z = (z + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+@lru_cache(maxsize=1 << 16)
+def _count_key(field: int, zone_id: int, count: int) -> int:
+    """Key of "count drivers of this kind in zone_id" (no drivers contribute nothing)"""
+    if count == 0:
+        return 0
+    return _mix(_mix(_mix(field) ^ (zone_id & _MASK64)) ^ count)
+
+
+def _frozen(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+class FleetState:
+    """
+    Compact, array-backed fleet representation for the state space search.
+
+    Driver index i maps to driver_ids[i], status[i] (status code), zone[i]
+    (current zone id) and destination[i] (destination zone id).
+
+    Child states are copy-on-write: ids, statuses and current zones don't
+    change during a search, so they are shared between all states and only
+    the destination array and the counts are copied when a batch of moves
+    is applied.
+
+    idle_counts[zone_id + 1] is the number of idle drivers in each zone
+    (slot 0 counts idle drivers outside every zone) and en_route maps a
+    destination zone to the number of online drivers heading there.
+    zobrist is a 64-bit hash over these counts and the engaged drivers per
+    zone, updated incrementally when moves are applied: states that only
+    differ by which interchangeable driver moved have the same key.
+    """
+
+    __slots__ = ("driver_ids", "status", "zone", "destination",
+                 "idle_counts", "en_route", "zobrist", "_index", "_idle_by_zone")
+
+    def __init__(self, driver_ids: List[str], status: np.ndarray, zone: np.ndarray,
+                 destination: np.ndarray, index: Optional[Dict[str, int]] = None,
+                 zobrist: Optional[int] = None, idle_counts: Optional[np.ndarray] = None,
+                 en_route: Optional[Dict[int, int]] = None):
+        self.driver_ids = driver_ids
+        self.status = status
+        self.zone = zone
+        self.destination = destination
+        self._index = index
+        self._idle_by_zone: Optional[Dict[int, np.ndarray]] = None
+
+        if idle_counts is None or en_route is None:
+            online = status == STATUS_ONLINE
+            idle = online & (destination == NO_ZONE)
+            idle_counts = _frozen(np.bincount(
+                zone[idle] + 1, minlength=int(zone.max(initial=NO_ZONE)) + 2).astype(np.int64))
+            destinations, counts = np.unique(
+                destination[online & ~idle], return_counts=True)
+            en_route = {int(zone_id): int(count)
+                        for zone_id, count in zip(destinations, counts)}
+        self.idle_counts = idle_counts
+        self.en_route = en_route
+
+        if zobrist is None:
+            zobrist = 0
+            for slot in np.flatnonzero(idle_counts):
+                zobrist ^= _count_key(_FIELD_IDLE, int(slot) - 1, int(idle_counts[slot]))
+            for zone_id, count in en_route.items():
+                zobrist ^= _count_key(_FIELD_EN_ROUTE, zone_id, count)
+            engaged_zones, engaged_counts = np.unique(
+                zone[status == STATUS_ENGAGED], return_counts=True)
+            for zone_id, count in zip(engaged_zones, engaged_counts):
+                zobrist ^= _count_key(_FIELD_ENGAGED, int(zone_id), int(count))
+        self.zobrist = zobrist
+
+    @classmethod
+    def from_earners(cls, earners: Sequence, driver_zones: Iterable[Optional[int]]) -> "FleetState":
+        """
+        Build a fleet state from Earners rows
+
+        Args:
+            earners: Earners (or any objects with earner_id, status, destination_zone)
+            driver_zones: Current zone id of each driver (None if outside all zones)
+        """
+        driver_ids = [earner.earner_id for earner in earners]
+        status = np.fromiter(
+            (STATUS_CODES.get(earner.status, STATUS_OTHER)
+             for earner in earners),
+            dtype=np.int8, count=len(earners))
+        zone = np.fromiter(
+            (NO_ZONE if zone_id is None else zone_id for zone_id in driver_zones),
+            dtype=np.int32, count=len(earners))
+        destination = np.fromiter(
+            (parse_zone_id(earner.destination_zone) for earner in earners),
+            dtype=np.int32, count=len(earners))
+
+        return cls(driver_ids, _frozen(status), _frozen(zone), _frozen(destination))
+
+    def __len__(self) -> int:
+        return len(self.driver_ids)
+
+    def __contains__(self, driver_id: str) -> bool:
+        return driver_id in self._driver_index()
+
+    def _driver_index(self) -> Dict[str, int]:
+        if self._index is None:
+            self._index = {driver_id: i for i,
+                           driver_id in enumerate(self.driver_ids)}
+        return self._index
+
+    def index_of(self, driver_id: str) -> int:
+        """Get the driver index for an earner id"""
+        return self._driver_index()[driver_id]
+
+    def changed_drivers(self, previous: "FleetState") -> List[str]:
+        """Ids of drivers whose status, zone or destination differ from previous (including added and removed drivers)"""
+        if self.driver_ids == previous.driver_ids:
+            changed = (self.status != previous.status) | (self.zone != previous.zone) | \
+                (self.destination != previous.destination)
+            return [self.driver_ids[i] for i in np.flatnonzero(changed)]
+
+        changed = []
+        for i, driver_id in enumerate(self.driver_ids):
+            if driver_id not in previous:
+                changed.append(driver_id)
+                continue
+            j = previous.index_of(driver_id)
+            if (self.status[i], self.zone[i], self.destination[i]) != \
+                    (previous.status[j], previous.zone[j], previous.destination[j]):
+                changed.append(driver_id)
+        changed.extend(driver_id for driver_id in previous.driver_ids if driver_id not in self)
+        return changed
+
+    def idle_mask(self) -> np.ndarray:
+        """Drivers that are online and have no destination"""
+        return (self.status == STATUS_ONLINE) & (self.destination == NO_ZONE)
+
+    def idle_indices(self) -> np.ndarray:
+        return np.flatnonzero(self.idle_mask())
+
+    def zone_counts(self, zone_count: int) -> np.ndarray:
+        """Number of idle drivers in each zone"""
+        counts = np.zeros(zone_count, dtype=np.int64)
+        known = min(zone_count, len(self.idle_counts) - 1)
+        counts[:known] = self.idle_counts[1:known + 1]
+        return counts
+
+    def idle_drivers_in_zone(self, zone_id: int) -> np.ndarray:
+        """Indices of the idle drivers in a zone (NO_ZONE: outside every zone)"""
+        # Computed once per state; all children of a state bind from it
+        if self._idle_by_zone is None:
+            idle = self.idle_indices()
+            zones = self.zone[idle]
+            self._idle_by_zone = {int(zone): idle[zones == zone]
+                                  for zone in np.unique(zones)}
+        return self._idle_by_zone.get(zone_id, np.empty(0, dtype=np.intp))
+
+    def idle_count(self, zone_id: int) -> int:
+        """Number of idle drivers in a zone (NO_ZONE: outside every zone)"""
+        slot = zone_id + 1
+        return int(self.idle_counts[slot]) if 0 <= slot < len(self.idle_counts) else 0
+
+    def child_zone_counts(self, zone_count: int, from_zone_lists: Sequence[Sequence[Optional[int]]]) -> np.ndarray:
+        """
+        Idle drivers per zone for many child states at once
+
+        Args:
+            zone_count: Number of zones
+            from_zone_lists: For each child, the zones that idle drivers leave
+                (None for drivers outside every zone)
+
+        Returns:
+            Matrix of shape (children, zones)
+        """
+        counts = np.repeat(self.zone_counts(zone_count)[None, :],
+                           len(from_zone_lists), axis=0)
+
+        rows = np.fromiter((row for row, zones in enumerate(from_zone_lists)
+                            for zone_id in zones if zone_id is not None and 0 <= zone_id < zone_count),
+                           dtype=np.intp)
+        zones = np.fromiter((zone_id for zones in from_zone_lists
+                             for zone_id in zones if zone_id is not None and 0 <= zone_id < zone_count),
+                            dtype=np.intp, count=len(rows))
+        # A driver that gets a destination stops counting as idle in its zone
+        np.subtract.at(counts, (rows, zones), 1)
+        return counts
+
+    def with_destinations(self, driver_indices: Sequence[int], to_zones: Sequence[int]) -> "FleetState":
+        """Create a child state where the given drivers head to new zones"""
+        destination = self.destination.copy()
+        idle_counts = self.idle_counts.copy()
+        en_route = dict(self.en_route)
+        zobrist = self.zobrist
+
+        for driver_index, to_zone in zip(driver_indices, to_zones):
+            from_destination = int(destination[driver_index])
+            destination[driver_index] = to_zone
+            if self.status[driver_index] != STATUS_ONLINE:
+                continue
+
+            # Leave the driver's current count...
+            if from_destination == NO_ZONE:
+                slot = int(self.zone[driver_index]) + 1
+                zobrist ^= _count_key(_FIELD_IDLE, slot - 1, int(idle_counts[slot])) ^ \
+                    _count_key(_FIELD_IDLE, slot - 1, int(idle_counts[slot]) - 1)
+                idle_counts[slot] -= 1
+            else:
+                count = en_route[from_destination]
+                zobrist ^= _count_key(_FIELD_EN_ROUTE, from_destination, count) ^ \
+                    _count_key(_FIELD_EN_ROUTE, from_destination, count - 1)
+                if count == 1:
+                    del en_route[from_destination]
+                else:
+                    en_route[from_destination] = count - 1
+
+            # ...and join the new one
+            if to_zone == NO_ZONE:
+                slot = int(self.zone[driver_index]) + 1
+                zobrist ^= _count_key(_FIELD_IDLE, slot - 1, int(idle_counts[slot])) ^ \
+                    _count_key(_FIELD_IDLE, slot - 1, int(idle_counts[slot]) + 1)
+                idle_counts[slot] += 1
+            else:
+                count = en_route.get(to_zone, 0)
+                zobrist ^= _count_key(_FIELD_EN_ROUTE, to_zone, count) ^ \
+                    _count_key(_FIELD_EN_ROUTE, to_zone, count + 1)
+                en_route[to_zone] = count + 1
+
+        return FleetState(self.driver_ids, self.status, self.zone, _frozen(destination),
+                          self._index, zobrist, _frozen(idle_counts), en_route)
+
+    def key(self) -> int:
+        """Canonical identity of the state (Zobrist hash), used for memoization and cycle detection"""
+        return self.zobrist
@@ -0,0 +1,364 @@
+import asyncio
+import heapq
+import os
+import random
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Optional, Set, Tuple
+from tortoise.expressions import Q
+from tortoise.signals import post_save
+from src.models import Earners
+from src.models.rides_trips import RidesTrips
+from src.utils.logger import logger
+
+# On the first load, trips that ended this long before the planning time
+# still free up their driver
+TRIP_WINDOW_MINUTES = int(os.getenv("TRIP_WINDOW_MINUTES", 30))
+
+# Seconds between write-behind flushes of changed statuses to the earners table
+FLEET_FLUSH_INTERVAL = float(os.getenv("FLEET_FLUSH_INTERVAL", 5))
+
+# Driver ids per bulk status UPDATE
+STATUS_UPDATE_CHUNK_SIZE = 1000
+
+# Snapshots of times before the tracker's clock kept in memory
+PAST_SNAPSHOT_CACHE_SIZE = 64
+
+# Tracker scope covering every city
+ALL_CITIES = object()
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    return value.replace(tzinfo=None) if value and value.tzinfo else value
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def bulk_update_status(driver_ids: Iterable[str], status: str) -> int:
+    """Set the status of many drivers with a few UPDATE ... WHERE earner_id IN (...) statements"""
+    updated_count = 0
+    for chunk in _chunks(driver_ids, STATUS_UPDATE_CHUNK_SIZE):
+        updated_count += await Earners.filter(earner_id__in=chunk).update(status=status)
+    return updated_count
+
+
+@dataclass(frozen=True)
+class FleetSnapshot:
+    """Consistent, read-only view of one city's driver statuses"""
+    city_id: Optional[int]
+    version: int  # changes whenever a status in the city changes
+    time: Optional[datetime]  # planning time the tracker has advanced to
+    statuses: Mapping[str, str]  # earner_id -> status
+    idle_driver_ids: FrozenSet[str]  # drivers that are online
+
+
+def apply_fleet_snapshot(drivers, snapshot: FleetSnapshot):
+    """Overwrite the drivers' (possibly stale) database statuses with the tracker's"""
+    for driver in drivers:
+        driver.status = snapshot.statuses.get(driver.earner_id, driver.status)
+
+
+class FleetTracker:
+    """
+    Long-lived driver status service
+
+    Active trips are kept in a min-heap by end time. Trips saved through
+    the ORM are added as they are created (see _track_saved_trip); trips
+    written some other way are picked up by polling: advancing the clock
+    loads the trips that started or ended since the previous time. Trips
+    that have ended are popped, and a driver without active trips goes
+    back online (or, with 50% chance, offline for a break).
+
+    The clock only moves forward. Statuses at an earlier time come from a
+    request-scoped tracker (see snapshot_at), so custom planning times in
+    the past don't rewind the shared state.
+
+    Statuses live in memory, with a per-city index of idle drivers, and
+    are written back to the earners table in bulk by flush() (called
+    periodically by run_write_behind()).
+    """
+
+    def __init__(self, window_minutes: int = TRIP_WINDOW_MINUTES, scope=ALL_CITIES):
+        self.window_minutes = window_minutes
+        self.scope = scope  # ALL_CITIES, or the one city_id a request-scoped tracker covers
+        self.time: Optional[datetime] = None
+        self._lock = asyncio.Lock()
+        self._status: Dict[str, str] = {}
+        self._city: Dict[str, Optional[int]] = {}
+        self._city_drivers: Dict[Optional[int], Set[str]] = {}
+        self._idle: Dict[Optional[int], Set[str]] = {}
+        self._city_versions: Dict[Optional[int], int] = {}
+        self._snapshots: Dict[Optional[int], FleetSnapshot] = {}
+        # (end_time, ride_id, driver_id) of trips that haven't ended yet
+        self._trip_heap: List[Tuple[datetime, str, str]] = []
+        self._tracked_rides: Set[str] = set()
+        self._active_trips: Dict[str, int] = {}  # driver_id -> trips in the heap
+        self._dirty: Dict[str, str] = {}  # driver_id -> status to persist
+        self._version = 0
+        self._past_snapshots: "OrderedDict[Tuple[Optional[int], datetime], FleetSnapshot]" = OrderedDict()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _advance_to(self, time: datetime) -> Dict[str, int]:
+        if self.time is None:
+            return await self._load(time)
+        if time <= self.time:
+            return {"trips_loaded": 0, "drivers_engaged": len(self._active_trips),
+                    "drivers_released": 0, "pending_writes": len(self._dirty)}
+        return await self._advance(self.time, time)
+
+    async def snapshot_at(self, city_id: Optional[int], time: datetime,
+                          live_until: Optional[datetime] = None) -> FleetSnapshot:
+        """
+        The city's statuses at time
+
+        Times at or after the clock advance it (checked and advanced under
+        the tracker's lock, so concurrent callers advance it once). Earlier
+        times are served from a request-scoped tracker loaded for just that
+        city and time, with a version of its own; these are cached until a
+        new trip is tracked. With live_until, a clock already past time but
+        still before live_until (e.g. later in the same planning tick) is
+        close enough: the live snapshot is served, with its own version.
+        """
+        time = _naive(time)
+        live_until = _naive(live_until)
+        async with self._lock:
+            if self.time is None or time >= self.time:
+                await self._advance_to(time)
+                return self.snapshot(city_id)
+            if live_until is not None and self.time < live_until:
+                return self.snapshot(city_id)
+
+            key = (city_id, time)
+            snapshot = self._past_snapshots.get(key)
+            if snapshot is not None:
+                self._past_snapshots.move_to_end(key)
+                return snapshot
+
+            # The scoped tracker reads statuses from the database
+            await self._flush()
+            past = FleetTracker(self.window_minutes, scope=city_id)
+            await past._load(time)
+            self._version += 1
+            snapshot = replace(past.snapshot(city_id), version=self._version)
+
+            self._past_snapshots[key] = snapshot
+            while len(self._past_snapshots) > PAST_SNAPSHOT_CACHE_SIZE:
+                self._past_snapshots.popitem(last=False)
+            return snapshot
+
+    async def _load(self, time: datetime) -> Dict[str, int]:
+        earners_query = Earners.all() if self.scope is ALL_CITIES else Earners.filter(home_city_id=self.scope)
+        earners = await earners_query.values_list("earner_id", "status", "home_city_id")
+
+        self._status.clear()
+        self._city.clear()
+        self._city_drivers.clear()
+        self._idle.clear()
+        self._snapshots.clear()
+        self._trip_heap.clear()
+        self._tracked_rides.clear()
+        self._active_trips.clear()
+        self._dirty.clear()
+
+        for earner_id, status, city_id in earners:
+            self._status[earner_id] = status
+            self._city[earner_id] = city_id
+            self._city_drivers.setdefault(city_id, set()).add(earner_id)
+            if status == "online":
+                self._idle.setdefault(city_id, set()).add(earner_id)
+            self._bump(city_id)
+
+        logger.info(f"Fleet tracker loaded {len(earners)} earners")
+        result = await self._advance(time - timedelta(minutes=self.window_minutes), time)
+
+        # Drivers left engaged in the database whose trip ended before the window
+        stale = [driver_id for driver_id, status in self._status.items()
+                 if status == "engaged" and driver_id not in self._active_trips]
+        for driver_id in stale:
+            self._release(driver_id)
+        result["drivers_released"] += len(stale)
+        return result
+
+    async def _advance(self, since: datetime, time: datetime) -> Dict[str, int]:
+        # Trips that ended in (since, time] or are active at time; the ones
+        # already in the heap are skipped
+        trips_query = RidesTrips.filter(
+            Q(end_time__gt=since, end_time__lte=time) |
+            Q(start_time__lt=time, end_time__gt=time)
+        )
+        if self.scope is not ALL_CITIES:
+            trips_query = trips_query.filter(driver__home_city_id=self.scope)
+        trips = await trips_query.values_list("ride_id", "driver_id", "start_time", "end_time")
+
+        for ride_id, driver_id, start_time, end_time in trips:
+            if ride_id not in self._tracked_rides:
+                self.add_trip(ride_id, driver_id, _naive(start_time), _naive(end_time), time)
+
+        self.time = time
+        drivers_released = self._release_ended_trips(time)
+
+        logger.info(
+            f"Fleet tracker at {time}: {len(self._active_trips)} engaged, {drivers_released} released, {len(self._dirty)} pending writes")
+        return {
+            "trips_loaded": len(trips),
+            "drivers_engaged": len(self._active_trips),
+            "drivers_released": drivers_released,
+            "pending_writes": len(self._dirty),
+        }
+
+    def add_trip(self, ride_id: str, driver_id: str, start_time: Optional[datetime],
+                 end_time: Optional[datetime], time: Optional[datetime] = None):
+        """
+        Track a trip; its driver is engaged until end_time
+
+        Trips without an end time, or that start after time, are ignored.
+        Completed trips are released on the next advance.
+        """
+        time = self.time if time is None else time
+        if end_time is None or ride_id in self._tracked_rides:
+            return
+        if start_time is not None and time is not None and start_time >= time:
+            return
+
+        heapq.heappush(self._trip_heap, (end_time, ride_id, driver_id))
+        self._tracked_rides.add(ride_id)
+        self._active_trips[driver_id] = self._active_trips.get(driver_id, 0) + 1
+        self._set_status(driver_id, "engaged")
+        self._past_snapshots.clear()
+
+    async def track_trip(self, ride_id: str, driver_id: str, start_time: Optional[datetime],
+                         end_time: Optional[datetime]):
+        """add_trip for a trip that was just saved (ignored until the tracker is loaded)"""
+        async with self._lock:
+            if self.time is not None:
+                self.add_trip(ride_id, driver_id, _naive(start_time), _naive(end_time))
+
+    def _release_ended_trips(self, time: datetime) -> int:
+        released = 0
+        while self._trip_heap and self._trip_heap[0][0] <= time:
+            _, ride_id, driver_id = heapq.heappop(self._trip_heap)
+            self._tracked_rides.discard(ride_id)
+            self._active_trips[driver_id] -= 1
+            if self._active_trips[driver_id] == 0:
+                del self._active_trips[driver_id]
+                self._release(driver_id, ride_id)
+                released += 1
+        return released
+
+    def _release(self, driver_id: str, ride_id: Optional[str] = None):
+        # with 50% chance, make driver go offline for break; the draw is
+        # seeded by the driver and the trip that ended, so rebuilding the
+        # tracker from the same trips (e.g. for a past snapshot) gives the
+        # same fleet
+        offline = random.Random(f"{driver_id}:{ride_id}").random() < 0.5
+        self._set_status(driver_id, "offline" if offline else "online")
+
+    def _set_status(self, driver_id: str, status: str):
+        previous = self._status.get(driver_id)
+        if previous == status:
+            return
+
+        city_id = self._city.get(driver_id)
+        if driver_id not in self._city:
+            # Earner created after the tracker was loaded
+            self._city[driver_id] = None
+            self._city_drivers.setdefault(None, set()).add(driver_id)
+
+        self._status[driver_id] = status
+        idle = self._idle.setdefault(city_id, set())
+        if status == "online":
+            idle.add(driver_id)
+        else:
+            idle.discard(driver_id)
+
+        self._dirty[driver_id] = status
+        self._bump(city_id)
+
+    def _bump(self, city_id: Optional[int]):
+        self._version += 1
+        self._city_versions[city_id] = self._version
+
+    def snapshot(self, city_id: Optional[int]) -> FleetSnapshot:
+        """Statuses of the city's drivers, rebuilt only when one of them changed"""
+        version = self._city_versions.get(city_id, 0)
+        snapshot = self._snapshots.get(city_id)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        statuses = {driver_id: self._status[driver_id]
+                    for driver_id in self._city_drivers.get(city_id, ())}
+        snapshot = FleetSnapshot(
+            city_id=city_id,
+            version=version,
+            time=self.time,
+            statuses=statuses,
+            idle_driver_ids=frozenset(self._idle.get(city_id, ())),
+        )
+        self._snapshots[city_id] = snapshot
+        return snapshot
+
+    async def flush(self) -> int:
+        """Write changed statuses to the earners table"""
+        async with self._lock:
+            return await self._flush()
+
+    async def _flush(self) -> int:
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, {}
+        by_status: Dict[str, List[str]] = {}
+        for driver_id, status in dirty.items():
+            by_status.setdefault(status, []).append(driver_id)
+
+        try:
+            updated_count = 0
+            for status, driver_ids in by_status.items():
+                updated_count += await bulk_update_status(driver_ids, status)
+        except Exception:
+            # Keep the writes for the next flush, unless a newer status replaced them
+            self._dirty = {**dirty, **self._dirty}
+            raise
+
+        logger.debug(f"Fleet tracker flushed {updated_count} driver statuses")
+        return updated_count
+
+    async def run_write_behind(self, interval: float = FLEET_FLUSH_INTERVAL):
+        """Flush changed statuses every interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Fleet tracker flush failed: {e}")
+
+    def start(self, interval: float = FLEET_FLUSH_INTERVAL):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.run_write_behind(interval))
+
+    async def stop(self):
+        """Stop the write-behind task and persist what's left"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+# Global tracker instance
+fleet_tracker = FleetTracker()
+
+
+@post_save(RidesTrips)
+async def _track_saved_trip(sender, instance: RidesTrips, created: bool, using_db, update_fields):
+    """New trips engage their driver right away instead of at the next poll"""
+    if created:
+        await fleet_tracker.track_trip(instance.ride_id, instance.driver_id, instance.start_time, instance.end_time)
@@ -0,0 +1,497 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time as timing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import orjson
+from src.ml.fleet_state import FleetState
+from src.ml.planners import SSSPlanner, create_planner
+from src.ml.planning_context import PlanningContext, ActionLimits, LRUMemo, SearchTimeout, merge_cache_stats, DEFAULT_MEMO_MAX_ENTRIES, DEFAULT_MEMO_MAX_BYTES
+from src.ml.sss import (ActionBatch, bind_plan, eval_state, ordered_action_batches, plan_best_moves, search_root_children,
+                        merge_root_results)
+from src.ml.zone_density_cache import ZoneDensityCache
+from src.ml.zone_geometry import zones_version
+from src.utils.logger import logger
+
+PLANNER_WORKERS = int(os.getenv("PLANNER_WORKERS", os.cpu_count() or 1))
+
+# How many city data versions each worker keeps in memory
+WORKER_CITY_CACHE_SIZE = 8
+
+# A city's previous search is only reused by a replan at most this many
+# minutes later
+WARM_START_MAX_GAP_MINUTES = int(os.getenv("WARM_START_MAX_GAP_MINUTES", 30))
+
+
+@dataclass
+class CityPlanningData:
+    """Static per-city search inputs, shipped to the workers once per version"""
+    zones: list
+    densities: ZoneDensityCache
+    zone_centroids: Dict[int, Tuple[float, float]]
+    zone_bboxes: Dict[int, Tuple[float, float, float, float]]
+    zone_distances: Dict[Tuple[int, int], float]
+
+    @classmethod
+    def from_context(cls, ctx: PlanningContext) -> "CityPlanningData":
+        # Only the averaged density table is needed, not the raw records
+        densities = ZoneDensityCache(ctx.densities.cache_file, ctx.densities.time_window_minutes)
+        densities.cache = ctx.densities.cache
+        return cls(ctx.zones, densities, ctx.zone_centroids, ctx.zone_bboxes, ctx.zone_distances)
+
+    def version(self) -> str:
+        """Content hash identifying this version of the city's data"""
+        digest = hashlib.md5()
+        digest.update(zones_version(self.zones).encode())
+        digest.update(orjson.dumps(self.densities.cache,
+                      option=orjson.OPT_SORT_KEYS))
+        digest.update(orjson.dumps(sorted(self.zone_distances.items())))
+        return digest.hexdigest()
+
+    def new_context(self, max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES,
+                    max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES) -> PlanningContext:
+        """Fresh request-scoped context sharing this city's read-only caches"""
+        return PlanningContext(
+            zones=self.zones,
+            densities=self.densities,
+            memo=LRUMemo(max_memo_entries, max_memo_bytes),
+            zone_centroids=self.zone_centroids,
+            zone_bboxes=self.zone_bboxes,
+            zone_distances=self.zone_distances,
+        )
+
+
+@dataclass
+class PlanRequest:
+    """Per-call search inputs"""
+    fleet: FleetState
+    time: datetime
+    max_depth: int
+    max_simultaneous_actions: int = 3
+    iterative: bool = False  # iterative deepening until deadline / max_depth
+    deadline: Optional[float] = None  # time.monotonic() value
+    workers: int = 1  # > 1 splits the root's children across processes (sss only)
+    max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES
+    max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES
+    planner: str = SSSPlanner.name  # engine name, see planners.PLANNERS
+    planner_options: Dict[str, Any] = field(default_factory=dict)
+    max_nodes: Optional[int] = None  # explored-state budget
+    action_limits: ActionLimits = field(default_factory=ActionLimits)
+    warm_start: bool = False  # reuse the city's previous search (single worker only)
+
+    def new_context(self, data: "CityPlanningData") -> PlanningContext:
+        """Context for this request: memo caps, budget and action limits"""
+        ctx = data.new_context(self.max_memo_entries, self.max_memo_bytes)
+        ctx.deadline = self.deadline
+        ctx.max_nodes = self.max_nodes
+        ctx.action_limits = self.action_limits
+        return ctx
+
+    def search_settings(self) -> tuple:
+        """Parameters that memoized results and move ordering depend on"""
+        return (self.planner, sorted(self.planner_options.items()), self.max_simultaneous_actions,
+                self.action_limits, self.max_memo_entries, self.max_memo_bytes)
+
+    def create_planner(self):
+        options = dict(self.planner_options)
+        if self.planner == SSSPlanner.name:
+            options.setdefault("iterative", self.iterative)
+        return create_planner(self.planner, **options)
+
+
+@dataclass
+class PlanResult:
+    score: float
+    cost: float
+    optimal_action_batches: List[ActionBatch]
+    depth_reached: int
+    explored_states: int
+    search_duration: float  # seconds spent searching inside the worker
+    memo_stats: Dict[str, Any] = field(default_factory=dict)
+    leaf_cache_stats: Dict[str, Any] = field(default_factory=dict)
+    warm_start: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class WarmStart:
+    """A city's previous search, kept in the worker for the next replan"""
+    version: str
+    settings: tuple
+    fleet: FleetState
+    time: datetime
+    leaf_cache: LRUMemo
+    best_moves: Dict[Any, tuple]
+    result: PlanResult
+
+
+# Worker-side cache: version -> CityPlanningData
+_worker_city_data: "OrderedDict[str, CityPlanningData]" = OrderedDict()
+
+# Worker-side cache: city_id -> WarmStart
+_worker_warm_starts: "OrderedDict[int, WarmStart]" = OrderedDict()
+
+
+def _load_city_data(path: str, version: str) -> CityPlanningData:
+    data = _worker_city_data.get(version)
+    if data is not None:
+        _worker_city_data.move_to_end(version)
+        return data
+
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+
+    _worker_city_data[version] = data
+    while len(_worker_city_data) > WORKER_CITY_CACHE_SIZE:
+        _worker_city_data.popitem(last=False)
+    return data
+
+
+def _write_city_data(path: str, data: CityPlanningData):
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def _take_warm_start(city_id: Optional[int], version: str, request: PlanRequest) -> Optional[WarmStart]:
+    """The city's previous search in this worker, if the request can reuse it"""
+    warm = _worker_warm_starts.pop(city_id, None)
+    if warm is None or warm.version != version or warm.settings != request.search_settings():
+        return None
+    if not timedelta(0) <= request.time - warm.time <= timedelta(minutes=WARM_START_MAX_GAP_MINUTES):
+        return None
+    return warm
+
+
+def _keep_warm_start(city_id: Optional[int], warm: WarmStart):
+    _worker_warm_starts[city_id] = warm
+    while len(_worker_warm_starts) > WORKER_CITY_CACHE_SIZE:
+        _worker_warm_starts.popitem(last=False)
+
+
+def run_plan(path: str, version: str, request: PlanRequest, city_id: Optional[int] = None) -> PlanResult:
+    """
+    Worker entry point: run one state space search
+
+    With request.warm_start, the city's previous search in this worker is
+    reused: its leaf cache (evaluations are keyed by idle counts and
+    10-minute bucket, so they hold across ticks) and its move ordering.
+    The memo is not: a subtree's result depends on the whole fleet, its
+    exact time and its leaf horizon, none of which repeat once the clock
+    moves or a driver changes, so warm starts save evaluation time rather
+    than explored states. For the same planning time, if no driver
+    changed, the previous plan is returned without searching.
+    """
+    data = _load_city_data(path, version)
+    ctx = request.new_context(data)
+    warm = _take_warm_start(city_id, version, request) if request.warm_start else None
+    warm_info = {}
+
+    start = timing.time()
+    if warm is not None:
+        changed_drivers = request.fleet.changed_drivers(warm.fleet)
+        same_time = request.time == warm.time
+        warm_info = {"reused": "leaf_cache",
+                     "changed_drivers": len(changed_drivers)}
+
+        if same_time and not changed_drivers and warm.result.depth_reached >= request.max_depth:
+            _keep_warm_start(city_id, warm)
+            logger.info(f"Warm start: city {city_id} unchanged, reusing previous plan")
+            return replace(warm.result, explored_states=0, search_duration=timing.time() - start,
+                           warm_start={**warm_info, "reused": "plan"})
+
+        ctx.leaf_cache = warm.leaf_cache
+        ctx.leaf_cache.reset_stats()
+        ctx.best_moves = {**warm.best_moves, **plan_best_moves(
+            warm.fleet, warm.time, warm.result.optimal_action_batches)}
+
+    score, cost, batches, depth_reached = request.create_planner().plan(
+        ctx, request.fleet, request.time, request.max_depth, request.max_simultaneous_actions)
+    batches = bind_plan(request.fleet, batches)
+
+    result = PlanResult(
+        score=score,
+        cost=cost,
+        optimal_action_batches=batches,
+        depth_reached=depth_reached,
+        explored_states=ctx.explored_states,
+        search_duration=timing.time() - start,
+        memo_stats=ctx.memo.stats(),
+        leaf_cache_stats=ctx.leaf_cache.stats(),
+        warm_start=warm_info,
+    )
+
+    if request.warm_start:
+        _keep_warm_start(city_id, WarmStart(
+            version=version,
+            settings=request.search_settings(),
+            fleet=request.fleet,
+            time=request.time,
+            leaf_cache=ctx.leaf_cache,
+            best_moves={**ctx.best_moves, **ctx.next_best_moves},
+            result=result,
+        ))
+    return result
+
+
+class SharedAlpha:
+    """Best root score found so far, shared between root-split workers"""
+
+    def __init__(self, value, lock):
+        self._value = value
+        self._lock = lock
+
+    def get(self) -> float:
+        return self._value.value
+
+    def update(self, score: float):
+        with self._lock:
+            if score > self._value.value:
+                self._value.value = score
+
+
+def run_root_split(path: str, version: str, request: PlanRequest, child_indices: List[int],
+                   shared_alpha: SharedAlpha, best_moves: Dict[Any, tuple]) -> Tuple[Optional[list], int, Dict[str, Any], Dict[str, Any], Dict[Any, tuple]]:
+    """
+    Worker entry point: search some of the root's children
+
+    best_moves is the move ordering learned by the previous deepening
+    iteration; every worker gets the same one, so they all order the root's
+    children the same way.
+
+    Returns (child results, explored states, memo stats, leaf cache stats, best moves found);
+    child results are None if the budget ran out before all children were searched.
+    """
+    data = _load_city_data(path, version)
+    ctx = request.new_context(data)
+    ctx.best_moves = best_moves
+
+    try:
+        results = search_root_children(
+            ctx, request.fleet, request.time, request.max_depth, child_indices,
+            request.max_simultaneous_actions, shared_alpha)
+    except SearchTimeout:
+        results = None
+    return results, ctx.explored_states, ctx.memo.stats(), ctx.leaf_cache.stats(), ctx.next_best_moves
+
+
+class PlannerPool:
+    """
+    Managed process pool that runs state space searches off the event loop
+
+    City data is pickled to a file once per (city, version); workers load
+    it on first use and keep it in memory, so each call only ships the
+    fleet snapshot and search parameters.
+
+    Every worker is a single-process lane. Searches go to the least busy
+    lane, except warm-started ones, which always run on their city's lane
+    so the city's previous search is found in that worker's memory.
+    """
+
+    def __init__(self, max_workers: int = PLANNER_WORKERS):
+        self.max_workers = max_workers
+        self._lanes: List[ProcessPoolExecutor] = []
+        self._lane_load: List[int] = []  # searches submitted to each lane and not finished
+        self._data_dir: Optional[str] = None
+        self._published: Dict[int, Tuple[str, str]] = {}  # city_id -> (version, path)
+        self._writing: Dict[str, asyncio.Future] = {}  # path -> data file being written
+        self._path_users: Dict[str, int] = {}  # path -> running searches using the data file
+        self._manager = None
+        self._manager_lock = asyncio.Lock()
+
+    def _ensure_started(self):
+        if not self._lanes:
+            self._data_dir = tempfile.mkdtemp(prefix="planner-")
+            mp_context = multiprocessing.get_context("spawn")
+            self._lanes = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context)
+                           for _ in range(max(1, self.max_workers))]
+            self._lane_load = [0] * len(self._lanes)
+            logger.info(
+                f"Started planner pool with {len(self._lanes)} workers")
+
+    async def _run(self, lane: Optional[int], fn, *args):
+        """Run fn(*args) in a worker: on the given lane, or on the least busy one"""
+        if lane is None:
+            lane = min(range(len(self._lanes)), key=self._lane_load.__getitem__)
+        lane %= len(self._lanes)
+
+        self._lane_load[lane] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._lanes[lane], fn, *args)
+        finally:
+            self._lane_load[lane] -= 1
+
+    async def publish(self, city_id: int, data: CityPlanningData) -> Tuple[str, str]:
+        """
+        Write the city's data for the workers unless this version is already published
+
+        The pickle is written in a thread (concurrent publishes of the same
+        version share one write). The file of the version it replaces is
+        deleted as soon as no running search uses it.
+        """
+        version = data.version()
+        published = self._published.get(city_id)
+        if published is not None and published[0] == version:
+            return published
+
+        path = os.path.join(self._data_dir, f"{city_id}-{version}.pkl")
+        writing = self._writing.get(path)
+        if writing is None:
+            writing = asyncio.ensure_future(asyncio.to_thread(_write_city_data, path, data))
+            self._writing[path] = writing
+            writing.add_done_callback(lambda _: self._writing.pop(path, None))
+        await asyncio.shield(writing)
+
+        previous = self._published.get(city_id)
+        if previous is None or previous[1] != path:
+            self._published[city_id] = (version, path)
+            logger.info(f"Published planning data for city {city_id} ({version})")
+            if previous is not None:
+                self._delete_if_unused(previous[1])
+        return version, path
+
+    def _delete_if_unused(self, path: str):
+        """Delete a data file that is neither published nor used by a running search"""
+        if self._path_users.get(path) or any(path == published_path for _, published_path in self._published.values()):
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _ensure_manager(self):
+        """Start the manager process holding the root splits' shared alpha (once)"""
+        async with self._manager_lock:
+            if self._manager is None:
+                # Spawning the process takes a while; keep it off the event loop
+                self._manager = await asyncio.to_thread(multiprocessing.get_context("spawn").Manager)
+
+    async def plan(self, city_id: int, data: CityPlanningData, request: PlanRequest) -> PlanResult:
+        """Run a search in a worker process and await its result"""
+        self._ensure_started()
+        version, path = await self.publish(city_id, data)
+
+        # The file stays on disk until the search is done, even if a newer
+        # version is published meanwhile
+        self._path_users[path] = self._path_users.get(path, 0) + 1
+        try:
+            if request.workers > 1 and request.planner == SSSPlanner.name:
+                return await self._plan_root_split(data, path, version, request)
+
+            lane = city_id if request.warm_start else None
+            return await self._run(lane, run_plan, path, version, request, city_id)
+        finally:
+            self._path_users[path] -= 1
+            if not self._path_users[path]:
+                del self._path_users[path]
+                self._delete_if_unused(path)
+
+    async def _plan_root_split(self, data: CityPlanningData, path: str, version: str, request: PlanRequest) -> PlanResult:
+        """
+        Parallel search: the root's children are split round-robin between
+        request.workers tasks that share the best root score for pruning.
+        With request.iterative, each depth is searched this way until the
+        deadline passes, and the move ordering found by one depth is passed
+        to the next. request.max_nodes is a budget for the whole search, so
+        each depth's workers split what is left of it.
+        """
+        # The root is expanded here only to count its children; every worker
+        # expands it again (deterministically) instead of receiving it
+        ctx = request.new_context(data)
+        fleet, time = request.fleet, request.time
+        state_key = (fleet.key(), time.hour, time.minute // 10)
+        root_batches = ordered_action_batches(
+            ctx, fleet, time, state_key, request.max_simultaneous_actions)
+        if len(root_batches) <= 1:
+            return await self._run(None, run_plan, path, version, request)
+
+        await self._ensure_manager()
+
+        workers = min(request.workers, len(root_batches))
+        groups = [list(range(i, len(root_batches), workers))
+                  for i in range(workers)]
+        depth_limits = range(1, request.max_depth + 1) if request.iterative else [
+            request.max_depth]
+
+        start = timing.time()
+        best = None
+        depth_reached = 0
+        explored_states = 0
+        memo_stats, leaf_cache_stats = [], []
+        best_moves = {}
+
+        for depth_limit in depth_limits:
+            shared_alpha = SharedAlpha(self._manager.Value(
+                "d", float("-inf")), self._manager.Lock())
+            worker_max_nodes = None
+            if request.max_nodes is not None:
+                worker_max_nodes = max(1, (request.max_nodes - explored_states) // workers)
+            depth_request = replace(request, max_depth=depth_limit, max_nodes=worker_max_nodes)
+            outcomes = await asyncio.gather(*[
+                self._run(None, run_root_split, path, version,
+                          depth_request, group, shared_alpha, best_moves)
+                for group in groups
+            ])
+
+            next_best_moves = {}
+            for _, worker_explored, worker_memo_stats, worker_leaf_cache_stats, worker_best_moves in outcomes:
+                explored_states += worker_explored
+                memo_stats.append(worker_memo_stats)
+                leaf_cache_stats.append(worker_leaf_cache_stats)
+                next_best_moves.update(worker_best_moves)
+
+            if any(results is None for results, *_ in outcomes):
+                logger.info(
+                    f"Deadline reached during depth {depth_limit}, returning depth {depth_reached} plan")
+                break
+
+            best = merge_root_results(
+                [result for results, *_ in outcomes for result in results])
+            depth_reached = depth_limit
+
+            # The workers don't see the root's choice, add it with the plan's path
+            best_moves = {**next_best_moves, **plan_best_moves(fleet, time, best[2])}
+
+            if ctx.deadline_passed() or (request.max_nodes is not None and explored_states >= request.max_nodes):
+                break
+
+        if best is None:
+            # Not even depth 1 completed, fall back to the do-nothing plan
+            best = (eval_state(ctx, fleet, time, 2), 0, [])
+
+        score, cost, batches = best
+        return PlanResult(
+            score=score,
+            cost=cost,
+            optimal_action_batches=bind_plan(fleet, batches),
+            depth_reached=depth_reached,
+            explored_states=explored_states,
+            search_duration=timing.time() - start,
+            memo_stats=merge_cache_stats(memo_stats),
+            leaf_cache_stats=merge_cache_stats(leaf_cache_stats),
+        )
+
+    def shutdown(self):
+        for lane in self._lanes:
+            lane.shutdown(cancel_futures=True)
+        self._lanes = []
+        self._lane_load = []
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+        if self._data_dir is not None:
+            shutil.rmtree(self._data_dir, ignore_errors=True)
+            self._data_dir = None
+        self._published.clear()
+        self._path_users.clear()
+
+
+# Global pool instance
+planner_pool = PlannerPool()
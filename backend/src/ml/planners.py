@@ -0,0 +1,261 @@
+import math
+import random
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Type
+from src.ml.fleet_state import FleetState
+from src.ml.planning_context import PlanningContext
+from src.ml.sss import (ActionBatch, apply_action_batch, child_leaf_scores, eval_state, iterative_deepening_sss,
+                        ordered_action_batches, sss_function_optimized)
+from src.utils.logger import logger
+
+# (score, cost, optimal_action_batches, depth_reached)
+PlanOutcome = Tuple[float, float, List[ActionBatch], int]
+
+# Minutes between search steps
+STEP_MINUTES = 3
+
+# Travel cost (seconds) per point of score, as in the SSS
+COST_PER_SCORE_POINT = 5000
+
+DEFAULT_BEAM_WIDTH = 8
+DEFAULT_MCTS_EXPLORATION = 1.4
+
+# Explored-state budget for engines that need one when the request sets
+# neither a deadline nor max_nodes
+DEFAULT_NODE_BUDGET = 5000
+
+
+def step_time(time: datetime, depth: int) -> datetime:
+    return time + timedelta(minutes=STEP_MINUTES * depth)
+
+
+def state_key(fleet: FleetState, time: datetime):
+    return (fleet.key(), time.hour, time.minute // 10)
+
+
+class Planner(ABC):
+    """
+    Search engine that plans max_depth steps of action batches
+
+    Engines share the action generator (ordered_action_batches, capped by
+    ctx.action_limits) and the state evaluation, and stop when the
+    context's budget (ctx.deadline, ctx.max_nodes) runs out. Scores are
+    comparable between engines: the leaf evaluation after max_depth steps
+    minus the plan's travel cost / COST_PER_SCORE_POINT.
+    """
+    name: str
+
+    @abstractmethod
+    def plan(self, ctx: PlanningContext, fleet: FleetState, time: datetime, max_depth: int,
+             max_simultaneous_actions: int = 3) -> PlanOutcome:
+        """Returns (score, cost, optimal_action_batches, depth_reached)"""
+
+
+class SSSPlanner(Planner):
+    """Depth-first alpha-beta search (sss_function_optimized)"""
+    name = "sss"
+
+    def __init__(self, iterative: bool = False):
+        self.iterative = iterative
+
+    def plan(self, ctx, fleet, time, max_depth, max_simultaneous_actions=3) -> PlanOutcome:
+        if self.iterative:
+            return iterative_deepening_sss(ctx, fleet, time, max_depth, max_simultaneous_actions)
+
+        score, cost, batches = sss_function_optimized(
+            ctx, fleet, max_depth, 0, time, max_simultaneous_actions)
+        return score, cost, batches, max_depth
+
+
+@dataclass
+class _BeamEntry:
+    fleet: FleetState
+    score: float  # evaluation at this depth minus cost so far
+    cost: float
+    batches: List[ActionBatch]
+
+
+class BeamSearchPlanner(Planner):
+    """
+    Width-bounded breadth-first search
+
+    Each level expands every state in the beam, scores all children in one
+    vectorized pass per parent, and keeps the best width distinct states.
+    If the budget runs out during a level, the best plan of the previous
+    level is returned.
+    """
+    name = "beam"
+
+    def __init__(self, width: int = DEFAULT_BEAM_WIDTH):
+        self.width = max(1, width)
+
+    def plan(self, ctx, fleet, time, max_depth, max_simultaneous_actions=3) -> PlanOutcome:
+        ctx.explored_states += 1
+        beam = [_BeamEntry(fleet, eval_state(ctx, fleet, time, 2), 0, [])]
+        depth_reached = 0
+
+        for depth in range(max_depth):
+            parent_time = step_time(time, depth)
+            child_time = step_time(time, depth + 1)
+            candidates: Dict[int, _BeamEntry] = {}
+            exhausted = False
+
+            for entry in beam:
+                if ctx.budget_exhausted():
+                    exhausted = True
+                    break
+
+                action_batches = ordered_action_batches(
+                    ctx, entry.fleet, parent_time, state_key(entry.fleet, parent_time), max_simultaneous_actions)
+                ctx.explored_states += len(action_batches)
+                leaf_scores = child_leaf_scores(
+                    ctx, entry.fleet, action_batches, child_time)
+
+                for action_batch, leaf_score in zip(action_batches, leaf_scores):
+                    child = apply_action_batch(entry.fleet, action_batch)
+                    cost = entry.cost + action_batch.total_cost
+                    score = leaf_score - cost / COST_PER_SCORE_POINT
+                    known = candidates.get(child.key())
+                    if known is None or score > known.score or (score == known.score and cost < known.cost):
+                        candidates[child.key()] = _BeamEntry(
+                            child, score, cost, entry.batches + [action_batch])
+
+            if exhausted:
+                logger.info(
+                    f"Beam search budget used up during depth {depth + 1}, returning depth {depth_reached} plan")
+                break
+
+            beam = sorted(candidates.values(), key=lambda entry: (-entry.score, entry.cost))[:self.width]
+            depth_reached = depth + 1
+
+        best = beam[0]
+        return best.score, best.cost, best.batches, depth_reached
+
+
+@dataclass
+class _MCTSNode:
+    fleet: FleetState
+    depth: int
+    cost: float  # travel cost from the root
+    batch: Optional[ActionBatch] = None  # action that led here
+    parent: Optional["_MCTSNode"] = None
+    untried: Optional[List[ActionBatch]] = None  # generated on first visit
+    children: List["_MCTSNode"] = field(default_factory=list)
+    visits: int = 0
+    value: float = 0  # sum of rollout scores
+
+    def path(self) -> List[ActionBatch]:
+        batches = []
+        node = self
+        while node.parent is not None:
+            batches.append(node.batch)
+            node = node.parent
+        batches.reverse()
+        return batches
+
+
+class MCTSPlanner(Planner):
+    """
+    Monte Carlo tree search with random rollouts
+
+    Selection uses UCT with the exploration term scaled to the range of
+    rollout scores seen so far. Expansion follows the generator's move
+    order, and rollouts pick random action batches down to max_depth. The
+    best complete plan found by any rollout is returned.
+    """
+    name = "mcts"
+
+    def __init__(self, exploration: float = DEFAULT_MCTS_EXPLORATION, seed: Optional[int] = 0):
+        self.exploration = exploration
+        self.seed = seed
+
+    def plan(self, ctx, fleet, time, max_depth, max_simultaneous_actions=3) -> PlanOutcome:
+        if ctx.max_nodes is None and ctx.deadline is None:
+            ctx.max_nodes = ctx.explored_states + DEFAULT_NODE_BUDGET
+
+        rng = random.Random(self.seed)
+        root = _MCTSNode(fleet, 0, 0)
+        ctx.explored_states += 1
+        best = None
+        low, high = math.inf, -math.inf
+
+        def actions_of(state: FleetState, depth: int) -> List[ActionBatch]:
+            state_time = step_time(time, depth)
+            return ordered_action_batches(ctx, state, state_time, state_key(state, state_time),
+                                          max_simultaneous_actions)
+
+        while max_depth > 0 and not ctx.budget_exhausted():
+            # Selection
+            node = root
+            while node.depth < max_depth and node.untried is not None and not node.untried and node.children:
+                scale = self.exploration * (high - low if high > low else 1)
+                log_visits = math.log(node.visits)
+                node = max(node.children, key=lambda child: child.value / child.visits +
+                           scale * math.sqrt(log_visits / child.visits))
+
+            # Expansion
+            if node.depth < max_depth:
+                if node.untried is None:
+                    node.untried = actions_of(node.fleet, node.depth)
+                if node.untried:
+                    action_batch = node.untried.pop(0)
+                    child = _MCTSNode(apply_action_batch(node.fleet, action_batch), node.depth + 1,
+                                      node.cost + action_batch.total_cost, action_batch, node)
+                    node.children.append(child)
+                    ctx.explored_states += 1
+                    node = child
+
+            # Rollout
+            rollout_fleet, cost, rollout_batches = node.fleet, node.cost, []
+            for depth in range(node.depth, max_depth):
+                action_batches = actions_of(rollout_fleet, depth)
+                action_batch = rng.choice(action_batches)
+                rollout_fleet = apply_action_batch(rollout_fleet, action_batch)
+                cost += action_batch.total_cost
+                rollout_batches.append(action_batch)
+                ctx.explored_states += 1
+
+            # The leaf evaluation counts against the budget too, so
+            # re-visiting fully expanded leaves still terminates
+            ctx.explored_states += 1
+            score = eval_state(ctx, rollout_fleet, step_time(time, max_depth), 2) - cost / COST_PER_SCORE_POINT
+            low, high = min(low, score), max(high, score)
+            if best is None or score > best[0] or (score == best[0] and cost < best[1]):
+                best = (score, cost, node.path() + rollout_batches)
+
+            # Backpropagation
+            while node is not None:
+                node.visits += 1
+                node.value += score
+                node = node.parent
+
+        if best is None:
+            return eval_state(ctx, fleet, time, 2), 0, [], 0
+
+        logger.info(
+            f"MCTS: {root.visits} rollouts, {ctx.explored_states} states")
+        return (*best, max_depth)
+
+
+PLANNERS: Dict[str, Type[Planner]] = {
+    SSSPlanner.name: SSSPlanner,
+    BeamSearchPlanner.name: BeamSearchPlanner,
+    MCTSPlanner.name: MCTSPlanner,
+}
+
+
+def planner_options(planner: str, beam_width: int = DEFAULT_BEAM_WIDTH) -> dict:
+    """Engine-specific options from request parameters"""
+    if planner == BeamSearchPlanner.name:
+        return {"width": beam_width}
+    return {}
+
+
+def create_planner(name: str, **options) -> Planner:
+    """Create a planner engine by name ("sss", "beam" or "mcts")"""
+    planner_class = PLANNERS.get(name)
+    if planner_class is None:
+        raise ValueError(f"Unknown planner: {name}")
+    return planner_class(**options)
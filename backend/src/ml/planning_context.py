@@ -0,0 +1,238 @@
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+from src.ml.zone_density_cache import ZoneDensityCache
+from src.ml.zone_geometry import ZoneGeometry
+
+DEFAULT_MEMO_MAX_ENTRIES = 200_000
+DEFAULT_MEMO_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+DEFAULT_LEAF_CACHE_MAX_ENTRIES = 100_000
+DEFAULT_LEAF_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64 MB
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the context's deadline or node budget is used up"""
+
+
+def estimate_entry_size(key, value) -> int:
+    """
+    Memory footprint of a memo entry in bytes
+
+    Follows tuples, lists and dataclass fields, so the action batches of a
+    memoized plan (and their actions) are counted, each object once per
+    entry. Batches shared with other entries' plans are counted in each,
+    so the estimate errs high and max_bytes stays an upper limit.
+    """
+    size = 0
+    seen = set()
+    pending = [key, value]
+    while pending:
+        part = pending.pop()
+        if id(part) in seen:
+            continue
+        seen.add(id(part))
+        size += sys.getsizeof(part)
+        if isinstance(part, (tuple, list)):
+            pending.extend(part)
+        elif hasattr(part, "__dataclass_fields__"):
+            size += sys.getsizeof(part.__dict__)
+            pending.extend(part.__dict__.values())
+    return size
+
+
+def merge_cache_stats(stats_list) -> Dict[str, Any]:
+    """Combine the stats() of several LRUMemo instances (e.g. one per worker)"""
+    merged = {"hits": 0, "misses": 0, "evictions": 0}
+    for stats in stats_list:
+        for key in merged:
+            merged[key] += stats[key]
+    lookups = merged["hits"] + merged["misses"]
+    merged["hit_rate"] = round(merged["hits"] / lookups, 4) if lookups else 0
+    return merged
+
+
+class LRUMemo:
+    """
+    Bounded memoization table with least-recently-used eviction
+
+    Entries are evicted once either max_entries or max_bytes is exceeded.
+    Hits, misses and evictions are counted for reporting.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MEMO_MAX_ENTRIES, max_bytes: int = DEFAULT_MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+
+        size = estimate_entry_size(key, value)
+        self._entries[key] = (value, size)
+        self.bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def reset_stats(self):
+        """Start counting hits, misses and evictions from zero (entries are kept)"""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+@dataclass
+class ActionLimits:
+    """
+    Caps on the action generator and the branching factor
+
+    Smaller limits trade plan quality for latency (e.g. for large cities).
+    """
+    max_source_zones: int = 5  # zones with idle drivers considered per state
+    max_target_zones: int = 8  # destination zones per source zone
+    combination_pool: int = 20  # cheapest single moves combined into batches
+    max_combinations_per_size: int = 10  # batches per number of simultaneous moves
+    max_batches: int = 50  # action batches generated per state
+    max_children: int = 15  # action batches explored per state
+
+
+class SearchPath:
+    """
+    States on the current search path, for cycle detection
+
+    A single stack (plus a set for O(1) membership) shared by the whole
+    search: states are pushed when the search enters them and popped when
+    it leaves, instead of copying a visited set into every recursion.
+    """
+
+    def __init__(self):
+        self._stack: List[Hashable] = []
+        self._members = set()
+
+    def __len__(self) -> int:
+        return len(self._stack)
+
+    def __contains__(self, state_hash) -> bool:
+        return state_hash in self._members
+
+    def push(self, state_hash):
+        self._stack.append(state_hash)
+        self._members.add(state_hash)
+
+    def pop(self):
+        self._members.discard(self._stack.pop())
+
+
+@dataclass
+class PlanningContext:
+    """
+    State owned by a single planning request
+
+    Each state space search gets its own context, so concurrent searches
+    (even for different cities) never share memo entries, counters or
+    zone caches.
+    """
+    zones: list  # WKB per zone (zone_geometry.load_city_zones)
+    densities: ZoneDensityCache
+    memo: LRUMemo = field(default_factory=LRUMemo)
+    # (idle drivers per zone, time bucket, timeframe_count) -> leaf score
+    leaf_cache: LRUMemo = field(default_factory=lambda: LRUMemo(
+        DEFAULT_LEAF_CACHE_MAX_ENTRIES, DEFAULT_LEAF_CACHE_MAX_BYTES))
+    zone_centroids: Dict[int, Tuple[float, float]] = field(
+        default_factory=dict)  # lat, lng
+    # min_x, min_y, max_x, max_y
+    zone_bboxes: Dict[int, Tuple[float, float, float, float]] = field(
+        default_factory=dict)
+    zone_distances: Dict[Tuple[int, int], float] = field(default_factory=dict)
+    # Compiled zone shapes, shared between contexts of the same zones version
+    geometry: Optional[ZoneGeometry] = None
+    explored_states: int = 0
+    # Cycle detection; kept apart from the memo (the transposition table),
+    # which holds path-independent results only
+    path: SearchPath = field(default_factory=SearchPath)
+    cycle_hits: int = 0
+    # time.monotonic() value after which the search gives up (None = no limit)
+    deadline: Optional[float] = None
+    # Explored states after which the search gives up (None = no limit)
+    max_nodes: Optional[int] = None
+    action_limits: ActionLimits = field(default_factory=ActionLimits)
+    # (state key, time bucket) -> best move found by the previous iteration,
+    # used for move ordering in iterative deepening. The running search
+    # records into next_best_moves, so the ordering within one search
+    # doesn't depend on which subtrees were explored first.
+    best_moves: Dict[Hashable, Tuple[Tuple[int, int], ...]] = field(
+        default_factory=dict)
+    next_best_moves: Dict[Hashable, Tuple[Tuple[int, int], ...]] = field(
+        default_factory=dict)
+
+    def set_deadline(self, deadline_ms: Optional[int], start: Optional[float] = None):
+        """Set the deadline deadline_ms after start (defaults to now)"""
+        if deadline_ms is None:
+            self.deadline = None
+            return
+        start = time.monotonic() if start is None else start
+        self.deadline = start + deadline_ms / 1000
+
+    def deadline_passed(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def budget_exhausted(self) -> bool:
+        """Deadline passed or node budget used up"""
+        return (self.max_nodes is not None and self.explored_states >= self.max_nodes) or self.deadline_passed()
+
+    @classmethod
+    def for_city(cls, city, zones: list, max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES,
+                 max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES) -> "PlanningContext":
+        """Create a context from a Cities row (raw zone densities) and its zones (load_city_zones)"""
+        densities = ZoneDensityCache()
+        if city.zone_densities:
+            densities.load_raw_data(city.zone_densities)
+            densities.build_cache(save=False)
+
+        return cls(
+            zones=zones,
+            densities=densities,
+            memo=LRUMemo(max_memo_entries, max_memo_bytes),
+        )
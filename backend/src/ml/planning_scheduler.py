@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time as timing
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Dict, Optional
+from src.ml.city_plans import CityPlanCache, PlanSettings, city_plan_cache
+from src.ml.planner_pool import PLANNER_WORKERS
+from src.models import Cities
+from src.utils.logger import logger
+
+# Seconds between planning rounds over all cities (0 disables the scheduler)
+PLANNING_INTERVAL_SECONDS = float(os.getenv("PLANNING_INTERVAL_SECONDS", 60))
+
+# Cities planned at the same time (each search runs in a planner pool worker)
+PLANNING_CONCURRENCY = int(os.getenv("PLANNING_CONCURRENCY", PLANNER_WORKERS))
+
+
+@dataclass
+class CityScheduleStatus:
+    """Outcome of the scheduler's work on one city"""
+    planned: int = 0
+    skipped: int = 0
+    failed: int = 0
+    last_run: Optional[datetime] = None
+    last_tick: Optional[datetime] = None
+    fleet_version: Optional[int] = None
+    compute_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+class PlanningScheduler:
+    """
+    Background task that keeps every city's plan up to date
+
+    Every interval seconds, all cities are planned with the default
+    settings through the shared plan cache, at most concurrency at a time.
+    A city is skipped when its plan for the current tick and fleet version
+    already exists (or is being searched), so within a tick only fleet
+    changes trigger a replan. Request handlers then read these plans from
+    the cache instead of searching.
+    """
+
+    def __init__(self, cache: CityPlanCache = city_plan_cache, interval: float = PLANNING_INTERVAL_SECONDS,
+                 settings: PlanSettings = PlanSettings(), concurrency: int = PLANNING_CONCURRENCY):
+        self.cache = cache
+        self.interval = interval
+        self.settings = settings
+        self.concurrency = max(1, concurrency)
+        self.cities: Dict[int, CityScheduleStatus] = {}
+        self.rounds = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def run_once(self, time: Optional[datetime] = None) -> Dict[str, int]:
+        """Plan every city once; returns how many were planned, skipped and failed"""
+        time = time or datetime.now()
+        city_ids = await Cities.all().values_list("city_id", flat=True)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        outcomes = await asyncio.gather(*[self._plan_city(city_id, time, semaphore) for city_id in city_ids])
+        self.rounds += 1
+        return {outcome: outcomes.count(outcome) for outcome in ("planned", "skipped", "failed")}
+
+    async def _plan_city(self, city_id: int, time: datetime, semaphore: asyncio.Semaphore) -> str:
+        status = self.cities.setdefault(city_id, CityScheduleStatus())
+        async with semaphore:
+            status.last_run = datetime.now()
+            try:
+                tick, snapshot = await self.cache.current_snapshot(city_id, time)
+                if self.cache.contains(city_id, tick, snapshot.version, self.settings):
+                    status.skipped += 1
+                    return "skipped"
+
+                plan, _ = await self.cache.get(city_id, time, self.settings)
+            except Exception as e:
+                logger.error(f"Planning city {city_id} failed: {e}")
+                status.failed += 1
+                status.error = str(e)
+                return "failed"
+
+        if plan is None:
+            # City deleted since the round started
+            self.cities.pop(city_id, None)
+            return "skipped"
+
+        status.planned += 1
+        status.last_tick = plan.tick
+        status.fleet_version = plan.fleet_version
+        status.compute_seconds = round(plan.compute_seconds, 2)
+        status.error = None
+        return "planned"
+
+    async def run(self):
+        """Plan all cities every interval seconds until cancelled"""
+        while True:
+            start = timing.monotonic()
+            try:
+                outcomes = await self.run_once()
+                logger.info(
+                    f"Planning round {self.rounds} took {timing.monotonic() - start:.2f}s: {outcomes}")
+            except Exception as e:
+                logger.error(f"Planning round failed: {e}")
+            await asyncio.sleep(max(0, self.interval - (timing.monotonic() - start)))
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"Started planning scheduler (every {self.interval:g}s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "interval_seconds": self.interval,
+            "rounds": self.rounds,
+            "plan_cache": self.cache.stats(),
+            "cities": {city_id: asdict(status) for city_id, status in self.cities.items()},
+        }
+
+
+# Global scheduler instance
+planning_scheduler = PlanningScheduler()
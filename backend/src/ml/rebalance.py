@@ -0,0 +1,187 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from src.ml.fleet_state import FleetState
+from src.ml.planning_context import PlanningContext
+from src.ml.sss import Action, ActionBatch
+from src.ml.state_eval import score_zone_counts
+from src.utils.logger import logger
+
+# Value of filling one unit of zone deficit, in seconds of travel time. The
+# SSS charges cost / 5000 per score point, so one unit of deficit (one score
+# point) is worth 5000 seconds of driving.
+DEFICIT_BENEFIT_SECONDS = 5000
+
+# Travel time used when a zone pair has no precomputed distance (same
+# default as the SSS action generator)
+DEFAULT_TRAVEL_SECONDS = 3600
+
+
+def zone_supply_and_demand(ctx: PlanningContext, fleet: FleetState, time,
+                           timeframe_count: int = 2) -> Tuple[Dict[Optional[int], List[int]], np.ndarray]:
+    """
+    Movable drivers per zone and unfilled demand per zone
+
+    A zone with more idle drivers than its expected pickups can give away
+    the drivers above ceil(density); drivers outside every zone can always
+    move (their key is None). A zone with fewer idle drivers than its
+    expected pickups wants ceil(density - count) more. Expected pickups
+    are summed over timeframe_count 10-minute intervals, like the SSS's
+    leaf evaluation.
+
+    Returns:
+        (zone -> movable driver indices, deficit per zone)
+    """
+    zone_count = len(ctx.zones)
+    density = ctx.densities.get_density_horizon(time, timeframe_count, zone_count)
+    counts = fleet.zone_counts(zone_count)
+    deficit = np.ceil(np.maximum(density - counts, 0)).astype(np.int64)
+    keep = np.ceil(density).astype(np.int64)
+
+    supply: Dict[Optional[int], List[int]] = {}
+    for driver_index in fleet.idle_indices():
+        zone_id = int(fleet.zone[driver_index])
+        supply.setdefault(zone_id if 0 <= zone_id < zone_count else None,
+                          []).append(int(driver_index))
+
+    for zone_id, drivers in supply.items():
+        if zone_id is not None:
+            del drivers[:min(keep[zone_id], len(drivers))]
+
+    return {zone_id: drivers for zone_id, drivers in supply.items() if drivers}, deficit
+
+
+def min_cost_transport(supply: np.ndarray, demand: np.ndarray, cost: np.ndarray, unit_benefit: float) -> np.ndarray:
+    """
+    Most profitable transport plan, by successive shortest paths
+
+    Ships units from sources (supply) to sinks (demand) over arcs with the
+    given per-unit costs, where every shipped unit earns unit_benefit. The
+    cheapest augmenting path is found with Dijkstra on reduced costs
+    (Johnson potentials), and augmentation stops once the cheapest path
+    costs at least unit_benefit, which maximizes total profit. Runs in
+    O(flow * V^2) for V = sources + sinks.
+
+    Args:
+        supply: Units available at each source, shape (S,)
+        demand: Units wanted by each sink, shape (T,)
+        cost: Per-unit arc cost, shape (S, T), non-negative
+        unit_benefit: Profit of one delivered unit
+
+    Returns:
+        Units shipped on each arc, shape (S, T)
+    """
+    source_count, sink_count = cost.shape
+    # Nodes: 0 = super source, 1..S sources, S+1..S+T sinks, S+T+1 = super sink
+    node_count = source_count + sink_count + 2
+    s, t = 0, node_count - 1
+    sources = np.arange(1, source_count + 1)
+    sinks = np.arange(source_count + 1, source_count + sink_count + 1)
+
+    capacity = np.zeros((node_count, node_count), dtype=np.int64)
+    arc_cost = np.zeros((node_count, node_count))
+    capacity[s, sources] = supply
+    capacity[sinks, t] = demand
+    big = int(supply.sum()) + 1
+    capacity[np.ix_(sources, sinks)] = big
+    arc_cost[np.ix_(sources, sinks)] = cost
+    arc_cost[np.ix_(sinks, sources)] = -cost.T  # residual (reverse) arcs
+
+    potential = np.zeros(node_count)
+    while True:
+        # Dijkstra over the residual graph with reduced costs
+        dist = np.full(node_count, np.inf)
+        previous = np.full(node_count, -1, dtype=np.int64)
+        done = np.zeros(node_count, dtype=bool)
+        dist[s] = 0
+        for _ in range(node_count):
+            candidates = np.where(done, np.inf, dist)
+            node = int(np.argmin(candidates))
+            if not np.isfinite(candidates[node]):
+                break
+            done[node] = True
+            reduced = arc_cost[node] + potential[node] - potential
+            relaxed = np.where(capacity[node] > 0, dist[node] + reduced, np.inf)
+            better = relaxed < dist
+            dist[better] = relaxed[better]
+            previous[better] = node
+
+        if not np.isfinite(dist[t]):
+            break
+        path_cost = dist[t] + potential[t] - potential[s]
+        if path_cost >= unit_benefit:
+            break
+        potential = np.where(np.isfinite(dist), potential + dist, potential)
+
+        # Bottleneck capacity along the path, then augment
+        path = [t]
+        while path[-1] != s:
+            path.append(int(previous[path[-1]]))
+        path.reverse()
+        amount = min(capacity[u, v] for u, v in zip(path, path[1:]))
+        for u, v in zip(path, path[1:]):
+            capacity[u, v] -= amount
+            capacity[v, u] += amount
+
+    # Flow on a source -> sink arc is what its reverse arc has accumulated
+    return capacity[np.ix_(sinks, sources)].T.copy()
+
+
+def plan_rebalance(ctx: PlanningContext, fleet: FleetState, time,
+                   unit_benefit: float = DEFICIT_BENEFIT_SECONDS) -> ActionBatch:
+    """
+    Rebalance the whole idle fleet towards zone deficits in one step
+
+    Surplus drivers are matched to deficit zones by a min-cost transport
+    over zones (costs are ctx.zone_distances travel times), then the
+    shipped units are turned into moves of concrete drivers.
+    """
+    supply, deficit = zone_supply_and_demand(ctx, fleet, time)
+    source_zones = list(supply.keys())
+    sink_zones = [int(zone_id) for zone_id in np.flatnonzero(deficit)]
+
+    if not source_zones or not sink_zones:
+        return ActionBatch(actions=[], total_cost=0, time=time)
+
+    cost = np.array([[ctx.zone_distances.get((from_zone, to_zone), DEFAULT_TRAVEL_SECONDS)
+                      for to_zone in sink_zones] for from_zone in source_zones], dtype=np.float64)
+    shipped = min_cost_transport(
+        np.array([len(supply[zone_id]) for zone_id in source_zones]),
+        deficit[sink_zones], cost, unit_benefit)
+
+    actions = []
+    for i, from_zone in enumerate(source_zones):
+        drivers = iter(supply[from_zone])
+        for j, to_zone in enumerate(sink_zones):
+            for _ in range(int(shipped[i, j])):
+                driver_index = next(drivers)
+                actions.append(Action(
+                    driver_id=fleet.driver_ids[driver_index],
+                    from_zone=from_zone,
+                    to_zone=to_zone,
+                    cost=float(cost[i, j]),
+                    time=time,
+                    driver_index=driver_index,
+                ))
+
+    logger.info(
+        f"Rebalance: {sum(len(drivers) for drivers in supply.values())} movable drivers, "
+        f"{int(deficit.sum())} deficit units, {len(actions)} moves")
+    return ActionBatch(actions=actions, total_cost=sum(action.cost for action in actions), time=time)
+
+
+def projected_score(ctx: PlanningContext, fleet: FleetState, batch: ActionBatch, time, timeframe_count: int = 2) -> float:
+    """
+    Score of the fleet once the batch's drivers have arrived
+
+    Unlike eval_state, which only counts idle drivers where they are,
+    moved drivers are counted in their destination zone.
+    """
+    zone_count = len(ctx.zones)
+    counts = fleet.zone_counts(zone_count).astype(np.int64)
+    for action in batch.actions:
+        if action.from_zone is not None:
+            counts[action.from_zone] -= 1
+        counts[action.to_zone] += 1
+
+    density = ctx.densities.get_density_horizon(time, timeframe_count, zone_count)
+    return float(score_zone_counts(counts, density))
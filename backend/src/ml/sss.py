@@ -0,0 +1,580 @@
+import sys
+from src.ml.data import build_travel_time_matrix
+from src.ml.fleet_state import FleetState, NO_ZONE
+from src.ml.planning_context import PlanningContext, SearchTimeout
+from src.ml.state_eval import score_zone_counts, score_upper_bound
+from src.ml.zone_geometry import DRIVER_ZONE_DISTANCE, get_zone_geometry
+from src.utils.logger import logger
+from datetime import datetime, timedelta
+from collections import Counter
+from dataclasses import dataclass, replace
+from typing import Dict, Hashable, List, Optional, Tuple
+from itertools import combinations
+import numpy as np
+
+
+@dataclass
+class Action:
+    """Represents a single driver action"""
+    driver_id: Optional[str]  # None until the plan is bound to drivers
+    from_zone: Optional[int]
+    to_zone: int
+    cost: float
+    time: datetime
+    driver_index: Optional[int] = None  # index into FleetState arrays
+
+
+@dataclass
+class ActionBatch:
+    """Represents multiple simultaneous actions in one time step"""
+    actions: List[Action]
+    total_cost: float
+    time: datetime
+
+
+@dataclass
+class SearchResult:
+    """Result of state space search including optimal actions"""
+    score: float
+    cost: float
+    optimal_action_batches: List[ActionBatch]
+
+
+def precompute_zone_centroids(ctx: PlanningContext):
+    """Attach the city's compiled zone geometry (prepared shapes, centroids and bounding boxes)"""
+    # Compiled once per zones version and shared between requests
+    ctx.geometry = get_zone_geometry(ctx.zones)
+    ctx.zone_centroids = ctx.geometry.centroids
+    ctx.zone_bboxes = ctx.geometry.bboxes
+
+
+def build_fleet_state(drivers, ctx: PlanningContext) -> FleetState:
+    """Zone the whole fleet in one vectorized lookup and pack it into arrays"""
+    if ctx.geometry is None:
+        precompute_zone_centroids(ctx)
+
+    lats = np.fromiter((driver.latitude for driver in drivers), dtype=float, count=len(drivers))
+    lngs = np.fromiter((driver.longitude for driver in drivers), dtype=float, count=len(drivers))
+    driver_zones = ctx.geometry.zones_of_points(lats, lngs, DRIVER_ZONE_DISTANCE)
+    return FleetState.from_earners(drivers, driver_zones)
+
+
+async def precompute_zone_distances(ctx: PlanningContext, time):
+    """Pre-compute travel times between all zone centroids"""
+    ctx.zone_distances.clear()
+
+    zone_count = len(ctx.zones)
+    matrix = await build_travel_time_matrix([ctx.zone_centroids[i] for i in range(zone_count)], time)
+    for i in range(zone_count):
+        for j in range(zone_count):
+            if i != j:
+                ctx.zone_distances[(i, j)] = matrix[i, j].item()
+
+    logger.info(
+        f"Pre-computed {len(ctx.zone_distances)} zone-to-zone distances")
+
+
+def generate_action_combinations_optimized(ctx: PlanningContext, fleet: FleetState, time, max_simultaneous_actions=3):
+    """
+    Optimized action generation with better pruning and limited combinations
+
+    Idle drivers in the same zone are interchangeable, so moves are
+    generated per source zone (from_zone -> to_zone) with no driver bound;
+    apply_action_batch and bind_plan pick the concrete drivers.
+    """
+    zones = ctx.zones
+
+    # Get current zone densities for prioritization
+    current_densities = ctx.densities.get_density_for_time(
+        time) or [0] * len(zones)
+
+    # Count current driver distribution
+    drivers_in_zones = fleet.zone_counts(len(zones))
+    available = {zone_id: int(count) for zone_id, count in enumerate(drivers_in_zones) if count > 0}
+    outside_count = fleet.idle_count(NO_ZONE)
+    if outside_count:
+        available[None] = outside_count
+
+    if not available:
+        return [ActionBatch(actions=[], total_cost=0, time=time)]
+
+    def zone_density(zone_id):
+        # Safely get density, default to 1 if index out of range
+        return current_densities[zone_id] if zone_id < len(current_densities) else 1
+
+    # Limit to the most oversupplied source zones and top target zones for performance
+    limits = ctx.action_limits
+    source_zones = sorted(available, key=lambda zone_id: (
+        -(available[zone_id] - (0 if zone_id is None else zone_density(zone_id))),
+        -1 if zone_id is None else zone_id))[:limits.max_source_zones]
+    max_target_zones = min(len(zones), limits.max_target_zones)  # Limit zone options per source zone
+
+    # Generate promising actions only (top zones by density difference)
+    promising_actions = []
+    for source_zone in source_zones:
+        # Calculate zone priorities based on density deficit
+        zone_priorities = []
+
+        for zone_id in range(len(zones)):
+            if zone_id != source_zone:
+                density_deficit = max(
+                    0, zone_density(zone_id) - drivers_in_zones[zone_id])
+                if density_deficit > 0:  # Only consider zones with demand
+                    cost = ctx.zone_distances.get(
+                        (source_zone, zone_id), 3600)
+                    priority = density_deficit / \
+                        max(cost / 3600, 0.1)  # Benefit/cost ratio
+                    zone_priorities.append((zone_id, priority, cost))
+
+        # Sort by priority and take top zones
+        zone_priorities.sort(key=lambda x: x[1], reverse=True)
+
+        for zone_id, priority, cost in zone_priorities[:max_target_zones]:
+            action = Action(
+                driver_id=None,
+                from_zone=source_zone,
+                to_zone=zone_id,
+                cost=cost,
+                time=time
+            )
+            promising_actions.append(action)
+
+        # If no promising actions found, add some random actions as fallback
+        if not zone_priorities and source_zone is not None:
+            for zone_id in range(min(3, len(zones))):  # Try first 3 zones as fallback
+                if zone_id != source_zone:
+                    cost = ctx.zone_distances.get(
+                        (source_zone, zone_id), 3600)
+                    action = Action(
+                        driver_id=None,
+                        from_zone=source_zone,
+                        to_zone=zone_id,
+                        cost=cost,
+                        time=time
+                    )
+                    promising_actions.append(action)
+
+    # Generate action batches with limited combinations
+    # Do nothing option
+    action_batches = [ActionBatch(actions=[], total_cost=0, time=time)]
+
+    # Single driver actions
+    for action in promising_actions:
+        batch = ActionBatch(
+            actions=[action], total_cost=action.cost, time=time)
+        action_batches.append(batch)
+
+    # Limited multi-driver actions (only if beneficial)
+    if max_simultaneous_actions > 1 and len(promising_actions) > 1:
+        # Limit total combinations
+        max_combinations = min(limits.combination_pool, len(promising_actions))
+        sorted_actions = sorted(promising_actions, key=lambda a: a.cost)[
+            :max_combinations]
+
+        # Max 3 simultaneous
+        for num_actions in range(2, min(max_simultaneous_actions + 1, 4)):
+            combo_count = 0
+            for action_combo in combinations(sorted_actions, num_actions):
+                if combo_count >= limits.max_combinations_per_size:  # Limit combinations per size
+                    break
+
+                # Enough idle drivers in every source zone
+                leaving = Counter(action.from_zone for action in action_combo)
+                if all(count <= available[zone_id] for zone_id, count in leaving.items()):
+                    total_cost = sum(action.cost for action in action_combo)
+                    batch = ActionBatch(
+                        actions=list(action_combo),
+                        total_cost=total_cost,
+                        time=time
+                    )
+                    action_batches.append(batch)
+                    combo_count += 1
+
+    return action_batches[:limits.max_batches]  # Limit total action batches
+
+
+def eval_state(ctx: PlanningContext, fleet: FleetState, time, timeframe_count: int = 3) -> float:
+    # Timeframe count is how many 10-minute intervals to look ahead for density
+    # (default 3 = 30 minutes)
+    # Idle drivers per zone (zones are resolved once when the fleet is built)
+    drivers_in_zones = fleet.zone_counts(len(ctx.zones))
+
+    # logger.info(f"Evaluated state at time {time}, score: {score}")
+    return float(eval_states_batch(ctx, drivers_in_zones[None, :], time, timeframe_count)[0])
+
+
+def eval_states_batch(ctx: PlanningContext, counts: np.ndarray, time, timeframe_count: int = 3) -> np.ndarray:
+    """
+    Score many candidate states in one vectorized pass
+
+    Scores are cached in ctx.leaf_cache by (idle drivers per zone, 10-minute
+    time bucket, timeframe_count), since many branches reach the same
+    distribution; only the misses are scored.
+
+    Args:
+        ctx: Planning context of the search
+        counts: Idle drivers per zone for each state, shape (states, zones)
+        time: Evaluation time
+        timeframe_count: How many 10-minute intervals to look ahead for density
+
+    Returns:
+        Array of scores, one per state
+    """
+    counts = np.ascontiguousarray(counts, dtype=np.int64)
+    bucket = (time.weekday(), time.hour, time.minute // 10)
+    keys = [(row.tobytes(), bucket, timeframe_count) for row in counts]
+
+    scores = np.empty(len(keys))
+    missing = []
+    for i, key in enumerate(keys):
+        score = ctx.leaf_cache.get(key)
+        if score is None:
+            missing.append(i)
+        else:
+            scores[i] = score
+
+    if missing:
+        # Get density for current weekday/time summed over the next few intervals
+        zone_density = ctx.densities.get_density_horizon(
+            time, timeframe_count, len(ctx.zones))
+        computed = score_zone_counts(counts[missing], zone_density)
+        for i, score in zip(missing, computed.tolist()):
+            scores[i] = score
+            ctx.leaf_cache.put(keys[i], score)
+
+    return scores
+
+
+def batch_signature(batch: ActionBatch) -> Tuple[Tuple[int, int], ...]:
+    """Order-independent identity of an action batch (its zone-to-zone moves)"""
+    return tuple(sorted((NO_ZONE if action.from_zone is None else action.from_zone, action.to_zone)
+                        for action in batch.actions))
+
+
+def get_state_hash_optimized(fleet: FleetState, time: datetime) -> Tuple[int, datetime]:
+    """Generate optimized hash for game state"""
+    # The fleet's Zobrist hash is maintained incrementally as moves are applied
+    return fleet.key(), time
+
+
+def ordered_action_batches(ctx: PlanningContext, fleet: FleetState, time, state_key, max_simultaneous_actions=3) -> List[ActionBatch]:
+    """Generate the action batches of a state in exploration order (top ctx.action_limits.max_children)"""
+    action_batches = generate_action_combinations_optimized(
+        ctx, fleet, time, max_simultaneous_actions)
+
+    # Only "do nothing" action
+    if not action_batches or len(action_batches) == 1:
+        return action_batches
+
+    # Sort action batches by potential (heuristic: prioritize low-cost, high-demand moves)
+    def action_batch_priority(batch):
+        if not batch.actions:
+            return 0
+        # Simple heuristic: prefer lower cost actions to high-demand zones
+        return -batch.total_cost / max(len(batch.actions), 1)
+
+    action_batches.sort(key=action_batch_priority, reverse=True)
+
+    # Try the best move of the previous (shallower) iteration first
+    best_move = ctx.best_moves.get(state_key)
+    if best_move is not None:
+        for i, action_batch in enumerate(action_batches):
+            if batch_signature(action_batch) == best_move:
+                action_batches.insert(0, action_batches.pop(i))
+                break
+
+    # Early termination: only explore top N action batches
+    return action_batches[:ctx.action_limits.max_children]  # Limit exploration
+
+
+def bind_drivers(fleet: FleetState, action_batch: ActionBatch) -> List[int]:
+    """
+    Driver indices that carry out a batch in this fleet
+
+    Actions without a driver get the lowest-index idle drivers of their
+    source zone that the batch doesn't use yet.
+    """
+    driver_indices = []
+    taken = {}
+    for action in action_batch.actions:
+        if action.driver_index is not None:
+            driver_indices.append(action.driver_index)
+            continue
+        zone_id = NO_ZONE if action.from_zone is None else action.from_zone
+        if zone_id not in taken:
+            taken[zone_id] = iter(fleet.idle_drivers_in_zone(zone_id))
+        driver_indices.append(int(next(taken[zone_id])))
+    return driver_indices
+
+
+def apply_action_batch(fleet: FleetState, action_batch: ActionBatch) -> FleetState:
+    """Copy-on-write child state: only the destination array and counts are copied"""
+    return fleet.with_destinations(
+        bind_drivers(fleet, action_batch),
+        [action.to_zone for action in action_batch.actions])
+
+
+def bind_plan(fleet: FleetState, action_batches: List[ActionBatch]) -> List[ActionBatch]:
+    """
+    Bind concrete drivers to the zone-level actions of a plan
+
+    The search only tracks how many idle drivers each zone has, so the
+    drivers are picked when the final plan is emitted, by replaying it
+    from the fleet it was planned for.
+    """
+    bound_batches = []
+    for action_batch in action_batches:
+        driver_indices = bind_drivers(fleet, action_batch)
+        actions = [replace(action, driver_index=driver_index, driver_id=fleet.driver_ids[driver_index])
+                   for action, driver_index in zip(action_batch.actions, driver_indices)]
+        bound_batches.append(replace(action_batch, actions=actions))
+        fleet = fleet.with_destinations(
+            driver_indices, [action.to_zone for action in actions])
+    return bound_batches
+
+
+def child_leaf_scores(ctx: PlanningContext, fleet: FleetState, action_batches: List[ActionBatch], child_time) -> List[float]:
+    """Score the leaf children of a state in one vectorized pass"""
+    child_counts = fleet.child_zone_counts(
+        len(ctx.zones), [[action.from_zone for action in batch.actions] for batch in action_batches])
+    return eval_states_batch(ctx, child_counts, child_time, 2).tolist()
+
+
+def sss_function_optimized(ctx: PlanningContext, fleet: FleetState, max_depth, depth, time, max_simultaneous_actions=3, alpha=-sys.maxsize, beta=sys.maxsize, leaf_score=None):
+    """
+    Optimized SSS with memoization, alpha-beta pruning, and early termination
+
+    Returns (score, cost, action_batches) for the subtree below this state,
+    where cost only counts the moves inside the subtree, so a memoized
+    result doesn't depend on the path that reached the state.
+
+    leaf_score is the precomputed evaluation of this state when it is a leaf
+    (the parent scores all of its leaf children in one batch).
+    """
+    ctx.explored_states += 1
+
+    if ctx.explored_states % 1000 == 0:  # Reduced logging frequency
+        logger.info(f"Progress: {ctx.explored_states}, Depth: {depth}")
+
+    # Check the wall-clock deadline and node budget every few nodes
+    if ctx.explored_states % 64 == 0 and ctx.budget_exhausted():
+        raise SearchTimeout()
+
+    # Move ordering is shared at 10-minute granularity, but the memo is keyed
+    # on the exact step time and remaining depth: a subtree's plan depends
+    # on both (iterative deepening still reuses the iterations' shared subtrees)
+    state_key = (fleet.key(), time.hour, time.minute // 10)
+    memo_key = (fleet.key(), time, max_depth - depth)
+
+    cached = ctx.memo.get(memo_key)
+    if cached is not None:
+        return cached
+
+    # Generate state hash for cycle detection (simplified)
+    state_hash = get_state_hash_optimized(fleet, time)
+
+    if state_hash in ctx.path:
+        ctx.cycle_hits += 1
+        return -sys.maxsize - 1, 0, []
+
+    if depth == max_depth:
+        # Reduced timeframe for speed
+        score = leaf_score if leaf_score is not None else eval_state(
+            ctx, fleet, time, 2)
+        result = (score, 0, [])
+        ctx.memo.put(memo_key, result)
+        return result
+
+    cycle_hits = ctx.cycle_hits
+    ctx.path.push(state_hash)
+    try:
+        result = _expand_state(ctx, fleet, max_depth, depth, time, state_key,
+                               max_simultaneous_actions, alpha, beta)
+    finally:
+        ctx.path.pop()
+
+    # A subtree that ran into a cycle scored it against this path only
+    if ctx.cycle_hits == cycle_hits:
+        ctx.memo.put(memo_key, result)
+    return result
+
+
+def _expand_state(ctx: PlanningContext, fleet: FleetState, max_depth, depth, time, state_key,
+                  max_simultaneous_actions, alpha, beta):
+    """Search the children of a non-leaf state (sss_function_optimized's recursion)"""
+    best_score = -sys.maxsize - 1
+    best_cost = sys.maxsize
+    best_action_batches = []
+
+    # Use optimized action generation
+    action_batches = ordered_action_batches(
+        ctx, fleet, time, state_key, max_simultaneous_actions)
+
+    # Only "do nothing" action
+    if not action_batches or len(action_batches) == 1:
+        return sss_function_optimized(ctx, fleet, max_depth, depth + 1,
+                                      time + timedelta(minutes=3), max_simultaneous_actions, alpha, beta)
+
+    # Children are leaves: score all of them in one vectorized pass
+    leaf_scores = [None] * len(action_batches)
+    if depth + 1 == max_depth:
+        leaf_scores = child_leaf_scores(
+            ctx, fleet, action_batches, time + timedelta(minutes=3))
+
+    for action_batch, child_leaf_score in zip(action_batches, leaf_scores):
+        new_fleet = apply_action_batch(fleet, action_batch)
+
+        # Recursive call with alpha-beta pruning
+        recursive_score, recursive_cost, recursive_batches = sss_function_optimized(
+            ctx, new_fleet, max_depth, depth + 1,
+            time + timedelta(minutes=3), max_simultaneous_actions, alpha, beta,
+            child_leaf_score)
+
+        total_cost = action_batch.total_cost + recursive_cost
+        adjusted_score = recursive_score - total_cost / 5000
+
+        if adjusted_score > best_score or (adjusted_score == best_score and total_cost < best_cost):
+            best_score = adjusted_score
+            best_cost = total_cost
+            best_action_batches = [action_batch] + recursive_batches
+
+            # Update alpha for pruning
+            alpha = max(alpha, adjusted_score)
+
+        # Alpha-beta pruning
+        if beta <= alpha:
+            break  # Prune remaining branches
+
+    if best_action_batches:
+        ctx.next_best_moves[state_key] = batch_signature(
+            best_action_batches[0])
+
+    return best_score, best_cost, best_action_batches
+
+
+def plan_best_moves(fleet: FleetState, time, action_batches: List[ActionBatch]) -> Dict[Hashable, Tuple[Tuple[int, int], ...]]:
+    """
+    Move ordering that follows a plan: the state key before each of its
+    batches -> that batch's signature (see PlanningContext.best_moves)
+    """
+    best_moves = {}
+    for action_batch in action_batches:
+        best_moves[(fleet.key(), time.hour, time.minute // 10)] = batch_signature(action_batch)
+        fleet = apply_action_batch(fleet, action_batch)
+        time += timedelta(minutes=3)
+    return best_moves
+
+
+def search_root_children(ctx: PlanningContext, fleet: FleetState, time, max_depth: int, child_indices: List[int],
+                         max_simultaneous_actions=3, shared_alpha=None) -> List[Optional[Tuple[int, float, float, List[ActionBatch]]]]:
+    """
+    Search a subset of the root's children, for parallel root splitting.
+
+    Every worker expands the root the same way and searches the children at
+    child_indices. shared_alpha (an object with get() and update(score))
+    holds the best root score found by any worker; a child whose optimistic
+    bound is already below it is skipped, since it can't be part of the plan.
+    The bound is the best leaf score still reachable from the child's idle
+    counts (see score_upper_bound) minus the child's move cost.
+
+    Returns:
+        (index, adjusted_score, total_cost, action_batches) per searched child,
+        None for pruned children
+    """
+    state_key = (fleet.key(), time.hour, time.minute // 10)
+    action_batches = ordered_action_batches(
+        ctx, fleet, time, state_key, max_simultaneous_actions)
+    child_time = time + timedelta(minutes=3)
+
+    # No leaf below a child can score above its bound, and moves only lower the score
+    upper_bounds = [None] * len(action_batches)
+    if shared_alpha is not None:
+        leaf_time = time + timedelta(minutes=3 * max_depth)
+        child_counts = fleet.child_zone_counts(
+            len(ctx.zones), [[action.from_zone for action in action_batches[index].actions] for index in child_indices])
+        bounds = score_upper_bound(child_counts, ctx.densities.get_density_horizon(
+            leaf_time, 2, len(ctx.zones)))
+        for index, bound in zip(child_indices, bounds.tolist()):
+            upper_bounds[index] = bound
+
+    results = []
+    ctx.path.push(get_state_hash_optimized(fleet, time))
+    try:
+        for index in child_indices:
+            action_batch = action_batches[index]
+            if shared_alpha is not None and upper_bounds[index] - action_batch.total_cost / 5000 < shared_alpha.get():
+                results.append(None)
+                continue
+
+            leaf_score = None
+            if max_depth == 1:
+                leaf_score = child_leaf_scores(
+                    ctx, fleet, [action_batch], child_time)[0]
+
+            recursive_score, recursive_cost, recursive_batches = sss_function_optimized(
+                ctx, apply_action_batch(fleet, action_batch), max_depth, 1,
+                child_time, max_simultaneous_actions, leaf_score=leaf_score)
+
+            total_cost = action_batch.total_cost + recursive_cost
+            adjusted_score = recursive_score - total_cost / 5000
+            if shared_alpha is not None:
+                shared_alpha.update(adjusted_score)
+            results.append((index, adjusted_score, total_cost,
+                           [action_batch] + recursive_batches))
+    finally:
+        ctx.path.pop()
+
+    return results
+
+
+def merge_root_results(child_results) -> Tuple[float, float, List[ActionBatch]]:
+    """Pick the best root child exactly like the serial search does"""
+    best_score = -sys.maxsize - 1
+    best_cost = sys.maxsize
+    best_action_batches = []
+
+    for _, adjusted_score, total_cost, action_batches in sorted(
+            (result for result in child_results if result is not None), key=lambda result: result[0]):
+        if adjusted_score > best_score or (adjusted_score == best_score and total_cost < best_cost):
+            best_score = adjusted_score
+            best_cost = total_cost
+            best_action_batches = action_batches
+
+    return best_score, best_cost, best_action_batches
+
+
+def iterative_deepening_sss(ctx: PlanningContext, fleet: FleetState, time, max_depth: int, max_simultaneous_actions=3):
+    """
+    Anytime state space search: search depth 1, 2, ... until max_depth or
+    until the budget (ctx.deadline, ctx.max_nodes) runs out, and return the
+    plan of the deepest completed iteration. The memo and move ordering
+    carry over between iterations.
+
+    Returns:
+        (score, cost, optimal_action_batches, depth_reached)
+    """
+    # Depth 0 plan (do nothing), in case not even depth 1 completes
+    best = (eval_state(ctx, fleet, time, 2), 0, [])
+    depth_reached = 0
+
+    for depth_limit in range(1, max_depth + 1):
+        try:
+            result = sss_function_optimized(
+                ctx, fleet, depth_limit, 0, time, max_simultaneous_actions)
+        except SearchTimeout:
+            logger.info(
+                f"Deadline reached during depth {depth_limit}, returning depth {depth_reached} plan")
+            break
+        best = result
+        depth_reached = depth_limit
+
+        # Move ordering for the next iteration comes from this one (unless
+        # the whole iteration was answered by the memo)
+        if ctx.next_best_moves:
+            ctx.best_moves = ctx.next_best_moves
+            ctx.next_best_moves = {}
+
+        if ctx.budget_exhausted():
+            break
+
+    return (*best, depth_reached)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def score_zone_counts(counts: np.ndarray, density: np.ndarray) -> np.ndarray:
+    """
+    Score one or many fleet distributions against expected zone demand
+
+    Args:
+        counts: Idle drivers per zone, shape (zones,) or (states, zones)
+        density: Expected pickups per zone (EV), shape (zones,)
+
+    Returns:
+        Score per state (a scalar array for a single distribution)
+
+    For each zone, with c = driver count and EV = density:
+    - c == EV: balanced, score += 2c + 1
+    - c > EV: oversupply, score += c, but above 2 * EV we penalize the excess
+    - c < EV: undersupply, score -= EV - c
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    density = np.asarray(density, dtype=np.float64)
+    return _zone_scores(counts, density).sum(axis=-1)
+
+
+def _zone_scores(counts: np.ndarray, density: np.ndarray) -> np.ndarray:
+    diff = counts - density
+    oversupplied = counts - np.maximum(counts - 2 * density, 0)
+    return np.where(diff == 0, 2 * counts + 1,
+                    np.where(diff > 0, oversupplied, diff))
+
+
+def score_upper_bound(counts: np.ndarray, density: np.ndarray) -> np.ndarray:
+    """
+    Highest score reachable from one or many fleet distributions
+
+    Within a search, drivers only ever leave the idle counts (a moved
+    driver stops counting as idle), so a zone can only go from c down to
+    any count in [0, c]. Below EV a zone's score grows with c and above EV
+    it is min(c, 2 * EV), so the best reachable score of a zone is its
+    current one, unless it can still become balanced (integer EV <= c),
+    which scores 2 * EV + 1. Moves only subtract their cost on top.
+
+    Args:
+        counts: Idle drivers per zone, shape (zones,) or (states, zones)
+        density: Expected pickups per zone (EV), shape (zones,)
+
+    Returns:
+        Bound per state (a scalar array for a single distribution)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    density = np.asarray(density, dtype=np.float64)
+
+    zone_scores = _zone_scores(counts, density)
+    can_balance = (density == np.floor(density)) & (density <= counts)
+    return np.where(can_balance, np.maximum(zone_scores, 2 * density + 1), zone_scores).sum(axis=-1)
@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+import threading
+import time as timing
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+from src.utils.logger import logger
+
+# SQLite database holding every fetched travel time
+TRAVEL_TIME_DB = os.getenv("TRAVEL_TIME_DB", "travelTimes.sqlite3")
+
+# Seconds after which a stored travel time is fetched again (0 keeps them forever)
+TRAVEL_TIME_TTL_SECONDS = float(os.getenv("TRAVEL_TIME_TTL_SECONDS", 30 * 24 * 3600))
+
+# Old JSON cache (no departure times), imported once when the database is created
+LEGACY_TRAVEL_CACHE = "travelCache.json"
+
+# Bucket of travel times that hold for any departure time (legacy entries);
+# only used when the departure's own bucket has none
+ANY_TIME_BUCKET = -1
+
+# Keys per SELECT (SQLite limits the number of bound parameters)
+QUERY_BATCH = 500
+
+Point = Tuple[float, float]  # lat, lng
+
+
+def pair_key(origin: Point, destination: Point) -> str:
+    # Rounded coordinates to improve cache hit rate
+    return f"{round(origin[0], 6)},{round(origin[1], 6)}-{round(destination[0], 6)},{round(destination[1], 6)}"
+
+
+def time_bucket(time: datetime) -> int:
+    """Departure time bucket: hour of the week (0 = Monday 00:00)"""
+    return time.weekday() * 24 + time.hour
+
+
+class TravelTimeStore:
+    """
+    Travel times keyed by (origin, destination, departure hour of the week)
+
+    Backed by a SQLite database in WAL mode, so every process (uvicorn
+    workers, planner processes) can read while one writes, and a put only
+    appends or replaces its own rows instead of rewriting the whole cache.
+    Each process and thread opens its own connection. Entries older than
+    ttl seconds count as missing, so callers fetch and put them again.
+
+    Calls block (a writer can wait up to 30 s for the database lock), so
+    async code runs them in a thread (see data.build_travel_time_matrix).
+    """
+
+    def __init__(self, path: str = TRAVEL_TIME_DB, ttl: float = TRAVEL_TIME_TTL_SECONDS,
+                 legacy_cache: Optional[str] = LEGACY_TRAVEL_CACHE):
+        self.path = path
+        self.ttl = ttl
+        self.legacy_cache = legacy_cache
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            created = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'travel_times'").fetchone() is None
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS travel_times (
+                    pair TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    travel_time INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (pair, bucket)
+                ) WITHOUT ROWID""")
+            if created:
+                self._import_legacy(connection)
+
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _import_legacy(self, connection: sqlite3.Connection):
+        if not self.legacy_cache:
+            return
+        try:
+            with open(self.legacy_cache, 'r') as f:
+                legacy = json.load(f)
+        except FileNotFoundError:
+            return
+
+        # Stamped with the import time, not the file's: an old cache would
+        # otherwise be past the TTL, and be fetched again, as soon as it's imported
+        fetched_at = timing.time()
+        connection.executemany(
+            "INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?)",
+            [(key, ANY_TIME_BUCKET, int(travel_time), fetched_at) for key, travel_time in legacy.items()])
+        logger.info(f"Imported {len(legacy)} travel times from {self.legacy_cache}")
+
+    def get_many(self, pairs: Sequence[Tuple[Point, Point]], time: datetime) -> Dict[int, int]:
+        """Fresh travel times of the (origin, destination) pairs departing at time, by pair index"""
+        bucket = time_bucket(time)
+        oldest = timing.time() - self.ttl if self.ttl > 0 else float("-inf")
+        keys = [pair_key(origin, destination) for origin, destination in pairs]
+
+        found: Dict[str, Tuple[int, int]] = {}  # key -> (bucket, travel time)
+        connection = self._connection()
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), QUERY_BATCH):
+            batch = unique_keys[start:start + QUERY_BATCH]
+            rows = connection.execute(
+                f"SELECT pair, bucket, travel_time FROM travel_times "
+                f"WHERE bucket IN (?, ?) AND fetched_at >= ? AND pair IN ({', '.join('?' * len(batch))})",
+                [bucket, ANY_TIME_BUCKET, oldest, *batch])
+            for key, row_bucket, travel_time in rows:
+                # The departure's own bucket wins over an any-time entry
+                if key not in found or row_bucket == bucket:
+                    found[key] = (row_bucket, travel_time)
+
+        return {index: found[key][1] for index, key in enumerate(keys) if key in found}
+
+    def put_many(self, entries: Iterable[Tuple[Point, Point, int]], time: datetime):
+        """Store (origin, destination, travel time) entries for departures at time"""
+        bucket = time_bucket(time)
+        fetched_at = timing.time()
+        rows = [(pair_key(origin, destination), bucket, int(travel_time), fetched_at)
+                for origin, destination, travel_time in entries]
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?)", rows)
+
+
+# Global travel time store instance
+travel_time_store = TravelTimeStore()
@@ -1,29 +1,50 @@
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import defaultdict
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
 from src.utils.logger import logger
 
+WEEK_MINUTES = 7 * 24 * 60
+
+
+def _frozen(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
 
 class ZoneDensityCache:
-    def __init__(self, cache_file: str = "zoneDensityCache.json"):
+    def __init__(self, cache_file: str = "zoneDensityCache.json", time_window_minutes: int = 10):
         self.cache_file = cache_file
-        self.cache: Dict[str, List[float]] = {}
+        self.time_window_minutes = time_window_minutes
+        self.cache: Dict[str, Tuple[float, ...]] = {}
         self.raw_data: List[Dict] = []
 
+    @property
+    def cache(self) -> Dict[str, Tuple[float, ...]]:
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache: Dict[str, Sequence[float]]):
+        # Per-bucket densities are tuples, so callers can't corrupt the cache
+        self._cache = {time_key: tuple(densities)
+                       for time_key, densities in cache.items()}
+        self._prefix: Optional[np.ndarray] = None
+
     def load_raw_data(self, data: str):
         """Load raw zone density data from string"""
         self.raw_data = data
 
         logger.info(f"Loaded {len(self.raw_data)} raw density records")
 
-    def build_cache(self, time_window_minutes: int = 10):
+    def build_cache(self, time_window_minutes: int = 10, save: bool = True):
         """
         Build cache with average pickup values grouped by weekday, hour, and minute intervals
 
         Args:
             time_window_minutes: Size of time window in minutes (default 10 for 10-minute intervals)
+            save: If True, write the cache to cache_file
         """
         # Group data by weekday, hour, minute_interval, and zone
         grouped_data = defaultdict(lambda: defaultdict(list))
@@ -47,7 +68,7 @@ class ZoneDensityCache:
                 grouped_data[time_key][zone_idx].append(pickup_count)
 
         # Calculate averages for each time period and zone
-        self.cache = {}
+        cache = {}
         for time_key, zones_data in grouped_data.items():
             zone_averages = []
             max_zone_idx = max(zones_data.keys()) if zones_data else -1
@@ -61,10 +82,13 @@ class ZoneDensityCache:
                 else:
                     zone_averages.append(0.0)
 
-            self.cache[time_key] = zone_averages
+            cache[time_key] = zone_averages
 
+        self.cache = cache
+        self.time_window_minutes = time_window_minutes
         logger.info(f"Built cache with {len(self.cache)} time periods")
-        self.save_cache()
+        if save:
+            self.save_cache()
 
     def save_cache(self):
         """Save cache to file"""
@@ -84,7 +108,7 @@ class ZoneDensityCache:
             logger.warning(f"Cache file {self.cache_file} not found")
             return False
 
-    def get_density_for_time(self, dt: datetime, time_window_minutes: int = 10) -> List[float]:
+    def get_density_for_time(self, dt: datetime, time_window_minutes: int = 10) -> Sequence[float]:
         """
         Get average zone densities for a specific datetime
 
@@ -93,7 +117,7 @@ class ZoneDensityCache:
             time_window_minutes: Time window size used when building cache
 
         Returns:
-            List of average pickup counts per zone, or empty list if not found
+            Average pickup counts per zone (a read-only tuple), or empty if not found
         """
         weekday = dt.weekday()
         hour = dt.hour
@@ -104,7 +128,74 @@ class ZoneDensityCache:
 
         return self.cache.get(time_key, [])
 
-    def get_density_for_current_time(self, time_window_minutes: int = 10) -> List[float]:
+    def _bucket_index(self, dt: datetime) -> int:
+        """Position of dt's time window on the weekly timeline"""
+        minute_of_week = (dt.weekday() * 24 + dt.hour) * 60 + dt.minute
+        return minute_of_week // self.time_window_minutes
+
+    def _weekly_prefix(self) -> np.ndarray:
+        """
+        Cumulative densities over two copies of the weekly timeline
+
+        Row i is the sum of the first i time windows (starting Monday 00:00),
+        so any horizon that starts in the first week is one subtraction,
+        including horizons that wrap into the next day or week.
+        """
+        if self._prefix is None:
+            bucket_count = WEEK_MINUTES // self.time_window_minutes
+            zone_count = max((len(densities) for densities in self.cache.values()), default=0)
+            timeline = np.zeros((bucket_count, zone_count))
+
+            for time_key, densities in self.cache.items():
+                weekday, hour, minute_interval = (int(part) for part in time_key.split(":"))
+                bucket = ((weekday * 24 + hour) * 60 + minute_interval) // self.time_window_minutes
+                timeline[bucket, :len(densities)] = densities
+
+            prefix = np.zeros((2 * bucket_count + 1, zone_count))
+            np.cumsum(np.concatenate([timeline, timeline]), axis=0, out=prefix[1:])
+            self._prefix = _frozen(prefix)
+        return self._prefix
+
+    def get_density_horizon(self, dt: datetime, timeframe_count: int, zone_count: int,
+                            time_window_minutes: int = 10) -> np.ndarray:
+        """
+        Get zone densities summed over several consecutive time windows
+
+        Uses the weekly prefix sums, so any horizon is a single vector
+        subtraction (whole weeks are added as multiples of the weekly total).
+
+        Args:
+            dt: Start of the look-ahead horizon
+            timeframe_count: Number of time windows to sum
+            zone_count: Length of the returned vector (missing zones are 0)
+            time_window_minutes: Time window size used when building cache
+
+        Returns:
+            Read-only array of summed pickup counts per zone
+        """
+        if time_window_minutes != self.time_window_minutes:
+            horizon = np.zeros(zone_count)
+            for i in range(timeframe_count):
+                densities = self.get_density_for_time(
+                    dt + timedelta(minutes=i * time_window_minutes), time_window_minutes)
+                n = min(len(densities), zone_count)
+                horizon[:n] += densities[:n]
+            return _frozen(horizon)
+
+        prefix = self._weekly_prefix()
+        bucket_count = (len(prefix) - 1) // 2
+        weeks, remainder = divmod(timeframe_count, bucket_count)
+        start = self._bucket_index(dt)
+        summed = prefix[start + remainder] - prefix[start]
+        if weeks:
+            summed = summed + weeks * prefix[bucket_count]
+
+        horizon = np.zeros(zone_count)
+        n = min(len(summed), zone_count)
+        horizon[:n] = summed[:n]
+        return _frozen(horizon)
+
+    def get_density_for_current_time(self, time_window_minutes: int = 10) -> Sequence[float]:
         """Get zone densities for current time"""
         return self.get_density_for_time(datetime.now(), time_window_minutes)
 
@@ -138,11 +229,11 @@ def initialize_zone_density_cache(data: str = None, force_rebuild: bool = False)
             "No raw data provided. Cache will be empty.")
 
 
-def get_current_zone_densities() -> List[float]:
+def get_current_zone_densities() -> Sequence[float]:
     """Get zone densities for current time"""
     return zone_density_cache.get_density_for_current_time()
 
 
-def get_zone_densities_for_time(target_time: datetime) -> List[float]:
+def get_zone_densities_for_time(target_time: datetime) -> Sequence[float]:
     """Get zone densities for specific time"""
     return zone_density_cache.get_density_for_time(target_time)
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import MultiPolygon, Point, Polygon
+from src.ml.data import ZoneFormat, points_near_zones
+from tortoise.transactions import in_transaction
+from src.models.city_zones import CityZones
+from src.utils.logger import logger
+
+# Compiled cities kept in memory (keyed by zones version)
+ZONE_GEOMETRY_CACHE_SIZE = int(os.getenv("ZONE_GEOMETRY_CACHE_SIZE", 16))
+
+# Tolerance (degrees) of the driver-to-zone lookup
+DRIVER_ZONE_DISTANCE = 0.01
+
+# Tolerance (degrees) of the simplified zone variant served for display
+ZONE_SIMPLIFY_TOLERANCE = float(os.getenv("ZONE_SIMPLIFY_TOLERANCE", 0.0005))
+
+# Cell size (degrees) of the zone lookup raster (0 disables the raster)
+ZONE_RASTER_CELL_DEGREES = float(os.getenv("ZONE_RASTER_CELL_DEGREES", 0.002))
+
+# Largest raster per city; coarser cells are used for bigger cities
+ZONE_RASTER_MAX_CELLS = int(os.getenv("ZONE_RASTER_MAX_CELLS", 4_000_000))
+
+# Where rasters are stored, so every process can memory-map them
+ZONE_RASTER_DIR = os.getenv("ZONE_RASTER_DIR", os.path.join(tempfile.gettempdir(), "zone-rasters"))
+
+# Raster cell values besides zone ids
+NO_ZONE_CELL = -1  # no point of the cell is in a zone
+BOUNDARY_CELL = -2  # the answer differs within the cell, use the exact geometry
+
+# (cell, shape) pairs tested per vectorized batch while building a raster
+RASTER_BUILD_BATCH = 500_000
+
+
+def zones_version(zones: List[bytes]) -> str:
+    """Content hash of a city's zones (WKB per zone, see load_city_zones)"""
+    digest = hashlib.md5()
+    for zone in zones:
+        digest.update(len(zone).to_bytes(8, "little"))
+        digest.update(zone)
+    return digest.hexdigest()
+
+
+def zone_shapes(zone: ZoneFormat) -> List[Polygon]:
+    return [Polygon(shape["shell"], holes=shape["holes"]) for shape in zone]
+
+
+def encode_zone(zone: ZoneFormat) -> Tuple[bytes, bytes]:
+    """WKB of the zone's shapes as one MultiPolygon, and of its simplified variant"""
+    geometry = MultiPolygon(zone_shapes(zone))
+    simplified = shapely.simplify(geometry, ZONE_SIMPLIFY_TOLERANCE, preserve_topology=True)
+    return shapely.to_wkb(geometry), shapely.to_wkb(simplified)
+
+
+def zone_format(geometry) -> ZoneFormat:
+    """A (Multi)Polygon back in ZoneFormat, e.g. for the frontend"""
+    polygons = geometry.geoms if hasattr(geometry, "geoms") else [geometry]
+    return [
+        {
+            "shell": list(polygon.exterior.coords),
+            "holes": [list(hole.coords) for hole in polygon.interiors]
+        } for polygon in polygons if not polygon.is_empty
+    ]
+
+
+async def load_city_zones(city_id: int) -> List[bytes]:
+    """WKB of each of the city's zones, in zone id order"""
+    return await CityZones.filter(city_id=city_id).order_by("zone_index").values_list("geometry", flat=True)
+
+
+async def save_city_zones(city_id: int, zones: List[ZoneFormat]):
+    """Replace the city's zones (atomically: readers see the old or the new zones)"""
+    rows = []
+    for zone_index, zone in enumerate(zones):
+        geometry, simplified = encode_zone(zone)
+        rows.append(CityZones(city_id=city_id, zone_index=zone_index, geometry=geometry, simplified=simplified))
+    async with in_transaction() as connection:
+        await CityZones.filter(city_id=city_id).using_db(connection).delete()
+        await CityZones.bulk_create(rows, using_db=connection)
+
+
+class CompiledZone:
+    """
+    A zone's shapes, built and prepared once
+
+    near() gives the same answers as data.point_near_zone, without
+    rebuilding the polygons for every point.
+    """
+    __slots__ = ("shapes", "shape_bounds", "geometry")
+
+    def __init__(self, shapes: List[Polygon], geometry: Optional[MultiPolygon] = None):
+        self.shapes = shapes
+        for shape in self.shapes:
+            shapely.prepare(shape)
+        self.shape_bounds = [shape.bounds for shape in self.shapes]  # shell bounds
+        self.geometry = geometry if geometry is not None else MultiPolygon(self.shapes)
+
+    @classmethod
+    def from_format(cls, zone: ZoneFormat) -> "CompiledZone":
+        return cls(zone_shapes(zone))
+
+    @classmethod
+    def from_wkb(cls, wkb: bytes) -> "CompiledZone":
+        """Decode a stored zone straight into shapely objects"""
+        geometry = shapely.from_wkb(wkb)
+        return cls(list(geometry.geoms), geometry)
+
+    def near(self, lat: float, lng: float, distance: float = 0.0005) -> bool:
+        """Whether (lat, lng) is inside one of the shapes or within distance of it"""
+        point = Point(lng, lat)
+        for shape, (min_x, min_y, max_x, max_y) in zip(self.shapes, self.shape_bounds):
+            if (lng < min_x - distance or lng > max_x + distance or
+                    lat < min_y - distance or lat > max_y + distance):
+                continue
+            if shape.contains(point) or shape.distance(point) < distance:
+                return True
+        return False
+
+
+class ZoneRaster:
+    """
+    Lookup grid over a city's zones
+
+    cells[row, col] covers lat in [min_y + row * cell_size, + cell_size) and
+    lng in [min_x + col * cell_size, + cell_size), and holds the zone that
+    ZoneGeometry.zone_of_point returns for every point of the cell,
+    NO_ZONE_CELL if it returns None for all of them, or BOUNDARY_CELL if
+    the answer varies within the cell. Everything outside the grid is
+    outside every zone's bounding box, so it has no zone.
+    """
+
+    def __init__(self, cells: np.ndarray, min_x: float, min_y: float, cell_size: float, distance: float):
+        self.cells = cells
+        self.min_x = min_x
+        self.min_y = min_y
+        self.cell_size = cell_size
+        self.distance = distance
+
+    def lookup(self, lat: float, lng: float) -> int:
+        """Zone id, NO_ZONE_CELL or BOUNDARY_CELL for the point's cell"""
+        row = int((lat - self.min_y) // self.cell_size)
+        col = int((lng - self.min_x) // self.cell_size)
+        if 0 <= row < self.cells.shape[0] and 0 <= col < self.cells.shape[1]:
+            return int(self.cells[row, col])
+        return NO_ZONE_CELL
+
+    def lookup_many(self, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        """lookup for arrays of points"""
+        rows = (lats - self.min_y) // self.cell_size
+        cols = (lngs - self.min_x) // self.cell_size
+        inside = (0 <= rows) & (rows < self.cells.shape[0]) & (0 <= cols) & (cols < self.cells.shape[1])
+        cells = np.full(len(lats), NO_ZONE_CELL, dtype=np.int32)
+        cells[inside] = self.cells[rows[inside].astype(np.intp), cols[inside].astype(np.intp)]
+        return cells
+
+    @classmethod
+    def build(cls, geometry: "ZoneGeometry", cell_size: float = ZONE_RASTER_CELL_DEGREES,
+              distance: float = DRIVER_ZONE_DISTANCE) -> "ZoneRaster":
+        """
+        Classify every cell with vectorized shapely predicates
+
+        A cell belongs to a zone if that zone's bounding box contains the
+        cell and one of its shapes, buffered by distance, properly contains
+        it, while no shape of a lower zone id is within distance of the cell.
+        Only cells that overlap a shape's bounding box grown by distance are
+        tested at all, and exact distances are only computed for cells
+        between the inner and outer approximations of a shape's buffer.
+        """
+        bounds = geometry.zone_bounds
+        min_x, min_y = bounds[:, 0].min(), bounds[:, 1].min()
+        width, height = bounds[:, 2].max() - min_x, bounds[:, 3].max() - min_y
+        cell_size = max(cell_size, float(np.sqrt(width * height / ZONE_RASTER_MAX_CELLS)))
+        rows, cols = int(height // cell_size) + 1, int(width // cell_size) + 1
+
+        dtype = np.int16 if len(geometry) < np.iinfo(np.int16).max else np.int32
+        cells = np.full(rows * cols, NO_ZONE_CELL, dtype=dtype)
+
+        # (cell, shape) pairs whose cell overlaps the shape's bounding box
+        # grown by distance; every other cell is farther than distance from
+        # every shape
+        pair_cells, pair_shapes = [], []
+        for shape_index, (x_lo, y_lo, x_hi, y_hi) in enumerate(shapely.bounds(geometry.shapes)):
+            row_range = np.arange(max(0, int((y_lo - distance - min_y) // cell_size)),
+                                  min(rows, int((y_hi + distance - min_y) // cell_size) + 1))
+            col_range = np.arange(max(0, int((x_lo - distance - min_x) // cell_size)),
+                                  min(cols, int((x_hi + distance - min_x) // cell_size) + 1))
+            shape_cells = (row_range[:, None] * cols + col_range[None, :]).ravel()
+            pair_cells.append(shape_cells)
+            pair_shapes.append(np.full(len(shape_cells), shape_index))
+        if not pair_cells:
+            return cls(cells.reshape(rows, cols), float(min_x), float(min_y), cell_size, distance)
+
+        pair_cells = np.concatenate(pair_cells)
+        pair_shapes = np.concatenate(pair_shapes)
+        candidates, pair_cells = np.unique(pair_cells, return_inverse=True)
+        x0 = min_x + (candidates % cols) * cell_size
+        y0 = min_y + (candidates // cols) * cell_size
+        boxes = shapely.box(x0, y0, x0 + cell_size, y0 + cell_size)
+
+        # Buffer polygons lie inside the exact distance region (chords of
+        # the arcs); scaling by 1 / cos(half the arc step) gives one that
+        # contains it. Buffering repairs invalid shapes, so those are only
+        # tested exactly and their cells are left to the exact lookup
+        shapes = np.array(geometry.shapes, dtype=object)
+        valid = shapely.is_valid(shapes)
+        inner = shapely.buffer(shapes, distance)
+        outer = shapely.buffer(shapes, distance / np.cos(np.pi / 32) * 1.001)
+        shapely.prepare(inner)
+        shapely.prepare(outer)
+
+        pair_zones = geometry.shape_zones[pair_shapes]
+        first_zone = np.full(len(candidates), len(geometry))
+        owned = np.zeros(len(candidates), dtype=bool)
+
+        for start in range(0, len(pair_cells), RASTER_BUILD_BATCH):
+            batch = slice(start, start + RASTER_BUILD_BATCH)
+            cell_index, shape_index = pair_cells[batch], pair_shapes[batch]
+            cell_boxes, inner_shapes = boxes[cell_index], inner[shape_index]
+
+            within = valid[shape_index] & shapely.intersects(inner_shapes, cell_boxes)
+            unsure = ~within
+            unsure[unsure] = ~valid[shape_index[unsure]] | shapely.intersects(
+                outer[shape_index[unsure]], cell_boxes[unsure])
+            within[unsure] = shapely.dwithin(shapes[shape_index[unsure]], cell_boxes[unsure], distance)
+            np.minimum.at(first_zone, cell_index[within], pair_zones[batch][within])
+
+        for start in range(0, len(pair_cells), RASTER_BUILD_BATCH):
+            batch = slice(start, start + RASTER_BUILD_BATCH)
+            cell_index, shape_index, zone_index = pair_cells[batch], pair_shapes[batch], pair_zones[batch]
+
+            # Cells that the lowest nearby zone owns entirely
+            own = zone_index == first_zone[cell_index]
+            cell_index, shape_index, zone_index = cell_index[own], shape_index[own], zone_index[own]
+            zone_bounds = bounds[zone_index]
+            inside = (valid[shape_index] &
+                      (zone_bounds[:, 0] <= x0[cell_index]) & (zone_bounds[:, 1] <= y0[cell_index]) &
+                      (x0[cell_index] + cell_size <= zone_bounds[:, 2]) &
+                      (y0[cell_index] + cell_size <= zone_bounds[:, 3]))
+            inside[inside] = shapely.contains_properly(
+                inner[shape_index[inside]], boxes[cell_index[inside]])
+            np.logical_or.at(owned, cell_index, inside)
+
+        near = first_zone < len(geometry)
+        cells[candidates[near]] = np.where(owned[near], first_zone[near], BOUNDARY_CELL)
+        return cls(cells.reshape(rows, cols), float(min_x), float(min_y), cell_size, distance)
+
+    def save(self, path: str):
+        """Write the cells (path + .npy) and grid parameters (path + .json)"""
+        np.save(path + ".tmp.npy", self.cells)
+        with open(path + ".tmp.json", "w") as f:
+            json.dump({"min_x": self.min_x, "min_y": self.min_y,
+                       "cell_size": self.cell_size, "distance": self.distance}, f)
+        os.replace(path + ".tmp.json", path + ".json")
+        os.replace(path + ".tmp.npy", path + ".npy")
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ZoneRaster"]:
+        """Memory-map a saved raster, or None if there is none"""
+        try:
+            with open(path + ".json") as f:
+                params = json.load(f)
+            cells = np.load(path + ".npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        return cls(cells, **params)
+
+
+def load_or_build_raster(geometry: "ZoneGeometry", cell_size: float = ZONE_RASTER_CELL_DEGREES) -> ZoneRaster:
+    """The geometry's raster from ZONE_RASTER_DIR, built and saved there on first use"""
+    path = os.path.join(ZONE_RASTER_DIR, f"{geometry.version}-{cell_size:g}")
+    raster = ZoneRaster.load(path)
+    if raster is None:
+        raster = ZoneRaster.build(geometry, cell_size)
+        os.makedirs(ZONE_RASTER_DIR, exist_ok=True)
+        raster.save(path)
+        boundary = np.count_nonzero(raster.cells == BOUNDARY_CELL)
+        logger.info(
+            f"Built {raster.cells.shape[0]}x{raster.cells.shape[1]} zone raster ({boundary} boundary cells)")
+        raster = ZoneRaster.load(path) or raster
+    return raster
+
+
+class ZoneGeometry:
+    """
+    Compiled geometry of a city's zones: prepared shapes, centroids,
+    bounding boxes and an STRtree over every shape of every zone. Built
+    once per zones version (see get_zone_geometry) and shared read-only by
+    every request for the city. An optional raster answers most lookups
+    with one array read.
+    """
+
+    def __init__(self, zones: List[bytes], version: Optional[str] = None):
+        self.version = version or zones_version(zones)
+        self.raster: Optional[ZoneRaster] = None
+        self.zones = [CompiledZone.from_wkb(zone) for zone in zones]
+        self.centroids: Dict[int, Tuple[float, float]] = {}  # lat, lng
+        # min_x, min_y, max_x, max_y
+        self.bboxes: Dict[int, Tuple[float, float, float, float]] = {}
+
+        for zone_id, zone in enumerate(self.zones):
+            centroid = zone.geometry.centroid
+            self.centroids[zone_id] = (centroid.y, centroid.x)
+            self.bboxes[zone_id] = zone.geometry.bounds
+        self.zone_bounds = np.array([self.bboxes[zone_id] for zone_id in range(len(self.zones))],
+                                    dtype=float).reshape(-1, 4)
+
+        # All shapes in one R-tree; shape_zones maps tree indices to zone ids
+        self.shapes = [shape for zone in self.zones for shape in zone.shapes]
+        self.shape_zones = np.array([zone_id for zone_id, zone in enumerate(self.zones)
+                                     for _ in zone.shapes], dtype=np.int32)
+        self.tree = STRtree(self.shapes)
+
+    def __len__(self) -> int:
+        return len(self.zones)
+
+    def zone_of_point(self, lat: float, lng: float, distance: float = DRIVER_ZONE_DISTANCE) -> Optional[int]:
+        """
+        First zone whose bounding box contains the point and that is within
+        distance of it, or None
+
+        The raster answers directly unless the point is in a boundary cell;
+        otherwise the R-tree only returns the shapes within distance of the
+        point, so a lookup is O(log Z) instead of testing every zone.
+        """
+        if self.raster is not None and self.raster.distance == distance:
+            cell = self.raster.lookup(lat, lng)
+            if cell >= 0:
+                return cell
+            if cell == NO_ZONE_CELL:
+                return None
+
+        point = Point(lng, lat)
+        best = None
+        for shape_index in self.tree.query(point, predicate="dwithin", distance=distance):
+            zone_id = int(self.shape_zones[shape_index])
+            if best is not None and zone_id >= best:
+                continue
+
+            minx, miny, maxx, maxy = self.bboxes[zone_id]
+            # Quick bounding box check (lng=x, lat=y)
+            if not (minx <= lng <= maxx and miny <= lat <= maxy):
+                continue
+
+            # dwithin includes shapes at exactly distance, CompiledZone.near doesn't
+            shape = self.shapes[shape_index]
+            if shape.contains(point) or shape.distance(point) < distance:
+                best = zone_id
+        return best
+
+    def zones_of_points(self, lats, lngs, distance: float = DRIVER_ZONE_DISTANCE) -> np.ndarray:
+        """
+        zone_of_point for arrays of points in one call, -1 instead of None
+
+        Points in resolved raster cells are answered from the raster, all
+        others with one vectorized R-tree query (data.points_near_zones).
+        """
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        if self.raster is not None and self.raster.distance == distance:
+            zone_ids = self.raster.lookup_many(lats, lngs)
+        else:
+            zone_ids = np.full(len(lats), BOUNDARY_CELL, dtype=np.int32)
+
+        exact = zone_ids == BOUNDARY_CELL
+        if exact.any():
+            zone_ids[exact] = points_near_zones(
+                lats[exact], lngs[exact], self.shapes, self.shape_zones,
+                self.zone_bounds, distance, self.tree)
+        return zone_ids
+
+
+_geometry_cache: "OrderedDict[str, ZoneGeometry]" = OrderedDict()
+# Geometry is built in worker threads (see precompute_zone_centroids' callers)
+_geometry_cache_lock = threading.Lock()
+
+
+def get_zone_geometry(zones: List[bytes]) -> ZoneGeometry:
+    """The compiled geometry of the zones, built on the first call per zones version"""
+    version = zones_version(zones)
+    with _geometry_cache_lock:
+        geometry = _geometry_cache.get(version)
+        if geometry is not None:
+            _geometry_cache.move_to_end(version)
+            return geometry
+
+    geometry = ZoneGeometry(zones, version)
+    if ZONE_RASTER_CELL_DEGREES > 0 and len(geometry):
+        geometry.raster = load_or_build_raster(geometry)
+    with _geometry_cache_lock:
+        _geometry_cache[version] = geometry
+        while len(_geometry_cache) > ZONE_GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+
+    logger.info(f"Compiled geometry for {len(geometry)} zones ({version})")
+    return geometry
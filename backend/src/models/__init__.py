@@ -1,4 +1,5 @@
 from .cities import Cities
+from .city_zones import CityZones
 from .customers import Customers
 from .earners import Earners
 from .riders import Riders
@@ -8,13 +8,15 @@ from src.models.heatmap import Heatmap
 from src.models.jobs_like import JobsLike
 from src.models.rides_trips import RidesTrips
 from src.models.cancellation_rates import CancellationRates
+from src.models.city_zones import CityZones
 
 
 class Cities(Model):
     city_id = fields.IntField(pk=True)
     name = fields.CharField(max_length=100)
-    zones = fields.JSONField(null=True)  # ZoneFormat (in ml/data.py)
     zone_densities = fields.JSONField(null=True)  # [{ time: 999, pickups: [ pickup points for each zone ] } for each time interval]
+    # Reverse relation to CityZones (zone geometry, one row per zone)
+    city_zones: fields.ReverseRelation["CityZones"]
     earners: fields.ReverseRelation["Earners"]  # Reverse relation to Earners
     # Reverse relation to Merchants
     merchants: fields.ReverseRelation["Merchants"]
@@ -0,0 +1,20 @@
+from tortoise import fields, Model
+
+
+class CityZones(Model):
+    id = fields.IntField(pk=True)
+    city = fields.ForeignKeyField(
+        "models.Cities",
+        related_name="city_zones",
+        null=False
+    )
+    zone_index = fields.IntField()  # zone id used by the planners
+    geometry = fields.BinaryField()  # WKB MultiPolygon of the zone's shapes
+    simplified = fields.BinaryField()  # WKB MultiPolygon, simplified for display
+
+    class Meta:
+        table = "city_zones"
+        unique_together = (("city", "zone_index"),)
+
+    def __str__(self):
+        return f"{self.city_id} - {self.zone_index}"
@@ -4,7 +4,9 @@ import orjson as json
 
 from pydantic import BaseModel
 from src.models.jobs_like import JobsLike
-from src.ml.data import ZoneFormat, cut_zone_with_others, get_zone, point_near_zone
+from src.ml.city_plans import city_plan_cache
+from src.ml.data import ZoneFormat, cut_zone_with_others, get_zone
+from src.ml.zone_geometry import CompiledZone, save_city_zones
 from src.models.cities import Cities
 from src.schemas.auth import UserRegister, UserLogin, ForgotPassword, Token, RegisterResponse, LoginResponse
 from src.models.users import Users
@@ -18,6 +20,7 @@ def reprint(something):
 
 def generate_zones(pickup_points: list[JobsLike], seconds: int, min_interval_minutes: int):
     zones: list[ZoneFormat] = []
+    compiled_zones: list[CompiledZone] = [] # zones' shapes, built once per zone
     densities: list[dict[str, int | list[tuple[float, float]]]] = [] 
 
     def add_pickup(time: datetime, zone_index: int):
@@ -41,9 +44,9 @@ def generate_zones(pickup_points: list[JobsLike], seconds: int, min_interval_min
         point = (pickup_point.begin_checkpoint_actual_location_latitude, pickup_point.begin_checkpoint_actual_location_longitude)
 
         near_zone_index = -1
-        for j, zone in enumerate(zones):
-            reprint(f"{i} ({j}, {len(zone[0]["shell"])})")
-            if point_near_zone(point, zone):
+        for j, zone in enumerate(compiled_zones):
+            reprint(f"{i} ({j}, {len(zones[j][0]["shell"])})")
+            if zone.near(point[0], point[1]):
                 near_zone_index = j
                 break
         if near_zone_index != -1:
@@ -56,6 +59,7 @@ def generate_zones(pickup_points: list[JobsLike], seconds: int, min_interval_min
         
         if len(new_zone) > 0:
             zones.append(new_zone)
+            compiled_zones.append(CompiledZone.from_format(new_zone))
             if len(densities) == 0:
                 densities.append({ "time": int(pickup_point.begin_checkpoint_ata_utc.timestamp()), "pickups": [0] * (len(zones) - 1) + [1] })
             else:
@@ -80,9 +84,11 @@ async def update_city_zones(request: UpdateCityZonesRequest):
         all_pickup_points = await city.jobs_like_begin.all()
         print(f"{len(all_pickup_points)} pickup points")
         zones, densities = generate_zones(all_pickup_points, request.seconds, request.min_interval_minutes)
-        city.zones = json.dumps(zones)
+        await save_city_zones(city.city_id, zones)
         city.zone_densities = json.dumps(densities)
         await city.save()
+        # Plans searched with the old zones and densities are stale
+        city_plan_cache.invalidate(city.city_id)
 
 
     return "City zones updated suhhcessfully 🥀"
@@ -1,6 +1,9 @@
 from fastapi import APIRouter, status, Depends
+from src.ml.zone_geometry import zone_format
 from src.models.cities import Cities
+from src.models.city_zones import CityZones
 import numpy as np
+import shapely
 
 from src.utils.logger import logger
 
@@ -9,6 +12,12 @@ router = APIRouter(prefix="/heatmap", tags=["heatmap"])
 
 @router.get("/zones", status_code=status.HTTP_200_OK)
 async def get_heatmap_zones():
-    zones = await Cities.all().values("name", "zones")
-    
+    cities = await Cities.all().values("city_id", "name")
+    city_zones = {}
+    # Simplified shapes are enough for the map
+    for city_id, simplified in await CityZones.all().order_by("city_id", "zone_index").values_list("city_id", "simplified"):
+        city_zones.setdefault(city_id, []).append(zone_format(shapely.from_wkb(simplified)))
+
+    zones = [{"name": city["name"], "zones": city_zones.get(city["city_id"])} for city in cities]
+
     return zones
@@ -1,601 +1,42 @@
-import copy
-import sys
-import hashlib
-import json
-from src.models.rides_trips import RidesTrips
-from src.ml.data import get_travel_time, point_near_zone
-from src.ml.zone_density_cache import get_current_zone_densities, initialize_zone_density_cache, get_zone_densities_for_time
+import asyncio
+import time as timing
+from src.ml.city_plans import CityPlan, PlanSettings, city_plan_cache, ensure_driver_locations
+from src.ml.fleet_tracker import apply_fleet_snapshot, fleet_tracker
+from src.ml.planning_scheduler import planning_scheduler
+from src.ml.planners import PLANNERS, SSSPlanner, DEFAULT_BEAM_WIDTH
+from src.ml.planning_context import PlanningContext, ActionLimits, DEFAULT_MEMO_MAX_ENTRIES, DEFAULT_MEMO_MAX_BYTES
+from src.ml.rebalance import DEFICIT_BENEFIT_SECONDS, plan_rebalance, projected_score
+from src.ml.sss import build_fleet_state, eval_state, precompute_zone_centroids, precompute_zone_distances
+from src.ml.zone_geometry import load_city_zones
 from src.utils.logger import logger
 from fastapi import APIRouter
 from src.models import Cities, Earners
-from datetime import datetime, timedelta
-from shapely.geometry import Polygon, MultiPolygon
-import random
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
-from itertools import combinations, product
+from datetime import datetime
+from typing import Optional
 
 router = APIRouter(prefix="/predictions", tags=["predictions"])
 
-progress_counter = 0
+# Depth cap for deadline-driven iterative deepening when no max_depth is given
+MAX_ITERATIVE_DEPTH = 12
 
 
-async def update_driver_states_from_trips(time):
-    """
-    Load trips table into memory and update driver states.
-    Changes drivers from 'engaged' to 'online' when their trips are completed.
-    """
-    logger.info("Loading trips data and updating driver states...")
-
-    # Get all trips and load into memory
-    trips = await RidesTrips.all().select_related('driver')
-
-    # Track drivers who had trips
-    drivers_with_completed_trips = set()
-    drivers_with_active_trips = set()
-
-    for trip in trips:
-        trip_end_time = trip.end_time.replace(
-            tzinfo=None) if trip.end_time and trip.end_time.tzinfo else trip.end_time
-        trip_start_time = trip.start_time.replace(
-            tzinfo=None) if trip.start_time and trip.start_time.tzinfo else trip.start_time
-        current_time = time.replace(tzinfo=None) if time.tzinfo else time
-
-        if trip_end_time and trip_end_time <= current_time:
-            # Trip is completed
-            drivers_with_completed_trips.add(trip.driver.earner_id)
-        elif trip_start_time and trip_start_time < current_time and trip_end_time and trip_end_time > current_time:
-            # Trip is active (started but not ended, or ends in future)
-            drivers_with_active_trips.add(trip.driver.earner_id)
-
-        # Update driver states
-        updated_count = 0
-
-        # Set drivers with active trips to 'engaged'
-    for driver_id in drivers_with_active_trips:
-        await Earners.filter(earner_id=driver_id).update(status="engaged")
-        updated_count += 1
-        logger.debug(f"Set driver {driver_id} to 'engaged' (active trip)")
-
-        # Set drivers with only completed trips (no active trips) to 'online'
-        drivers_to_online = drivers_with_completed_trips - drivers_with_active_trips
-    for driver_id in drivers_to_online:
-        # with 50% chance, make driver go offline for break
-        if random.random() < 0.5:
-            await Earners.filter(earner_id=driver_id).update(status="offline")
-            updated_count += 1
-            logger.debug(f"Set driver {driver_id} to 'offline' for break")
-        else:
-            await Earners.filter(earner_id=driver_id).update(status="online")
-            updated_count += 1
-            logger.debug(
-                f"Set driver {driver_id} to 'online' (trip completed)")
-
-    logger.info(
-        f"Updated {updated_count} driver states based on trip data")
-    logger.info(
-        f"Active trips: {len(drivers_with_active_trips)}, Completed trips: {len(drivers_to_online)}")
-
+def plan_cache_info(plan: CityPlan, cached: bool) -> dict:
+    """Which shared plan a response was served from"""
     return {
-        "trips_loaded": len(trips),
-        "drivers_engaged": len(drivers_with_active_trips),
-        "drivers_online": len(drivers_to_online),
-        "total_updated": updated_count
+        "cached": cached,
+        "tick": plan.tick.isoformat(),
+        "fleet_version": plan.fleet_version,
+        "computed_at": plan.computed_at.isoformat(),
+        "compute_seconds": round(plan.compute_seconds, 2),
     }
 
 
-@dataclass
-class DriverState:
-    """Lightweight driver state representation"""
-    earner_id: str
-    status: str
-    latitude: float
-    longitude: float
-    current_zone: Optional[int] = None
-    destination_zone: Optional[int] = None
-
-
-@dataclass
-class Action:
-    """Represents a single driver action"""
-    driver_id: str
-    from_zone: Optional[int]
-    to_zone: int
-    cost: float
-    time: datetime
-
-
-@dataclass
-class ActionBatch:
-    """Represents multiple simultaneous actions in one time step"""
-    actions: List[Action]
-    total_cost: float
-    time: datetime
-
-
-@dataclass
-class GameState:
-    """Immutable game state representation"""
-    driver_assignments: Dict[str, Optional[int]
-                             ]  # driver_id -> destination_zone
-    time: datetime
-
-    def copy_with_assignment(self, driver_id: str, zone_id: Optional[int]) -> 'GameState':
-        """Create new state with single driver assignment change"""
-        new_assignments = self.driver_assignments.copy()
-        new_assignments[driver_id] = zone_id
-        return GameState(new_assignments, self.time)
-
-
-@dataclass
-class SearchResult:
-    """Result of state space search including optimal actions"""
-    score: float
-    cost: float
-    optimal_action_batches: List[ActionBatch]
-
-
-# Global cache for zone centroids and distances
-zone_centroids_cache: Dict[int, Tuple[float, float]] = {}
-zone_distance_cache: Dict[Tuple[int, int], float] = {}
-driver_zone_cache: Dict[str, int] = {}
-# min_x, max_x, min_y, max_y
-zone_bboxes_cache: Dict[int, Tuple[float, float, float, float]] = {}
-
-
-def precompute_zone_centroids(zones):
-    """Pre-compute zone centroids and bounding boxes for faster distance calculations"""
-    global zone_centroids_cache, zone_bboxes_cache
-    zone_centroids_cache.clear()
-    zone_bboxes_cache.clear()
-
-    for zone_id, zone in enumerate(zones):
-        zone_shapes = [Polygon(shape["shell"], holes=shape["holes"])
-                       for shape in zone]
-        zone_multipolygon = MultiPolygon(zone_shapes)
-        centroid = zone_multipolygon.centroid
-        zone_centroids_cache[zone_id] = (centroid.y, centroid.x)  # lat, lng
-
-        # Pre-compute bounding box for fast spatial queries
-        bounds = zone_multipolygon.bounds  # (minx, miny, maxx, maxy)
-        zone_bboxes_cache[zone_id] = bounds
-
-    logger.info(
-        f"Pre-computed centroids and bounding boxes for {len(zone_centroids_cache)} zones")
-
-
-def get_driver_zone_optimized(driver_lat: float, driver_lng: float, zones) -> Optional[int]:
-    """Optimized zone lookup with bounding box checks and caching"""
-    # Create cache key based on rounded coordinates
-    cache_key = f"{round(driver_lat, 5)},{round(driver_lng, 5)}"
-
-    if cache_key in driver_zone_cache:
-        return driver_zone_cache[cache_key]
-
-    # Use bounding box for fast elimination before expensive geometric operations
-    for zone_id in range(len(zones)):
-        if zone_id in zone_bboxes_cache:
-            minx, miny, maxx, maxy = zone_bboxes_cache[zone_id]
-            # Quick bounding box check (lng=x, lat=y)
-            if not (minx <= driver_lng <= maxx and miny <= driver_lat <= maxy):
-                continue
-
-        # Only do expensive point_near_zone check if bounding box passes
-        if point_near_zone([driver_lat, driver_lng], zones[zone_id], 0.01):
-            driver_zone_cache[cache_key] = zone_id
-            return zone_id
-
-    driver_zone_cache[cache_key] = None
-    return None
-
-
-def precompute_zone_distances(zones, time):
-    """Pre-compute travel times between all zone centroids"""
-    global zone_distance_cache
-    zone_distance_cache.clear()
-
-    for i in range(len(zones)):
-        for j in range(len(zones)):
-            if i != j and (i, j) not in zone_distance_cache:
-                origin = zone_centroids_cache[i]
-                destination = zone_centroids_cache[j]
-                travel_time = get_travel_time(origin, destination, time)
-                zone_distance_cache[(i, j)] = travel_time
-
-    logger.info(
-        f"Pre-computed {len(zone_distance_cache)} zone-to-zone distances")
-
-
-def generate_action_combinations_optimized(drivers, zones, time, max_simultaneous_actions=3):
-    """Optimized action generation with better pruning and limited combinations"""
-
-    # Get all idle drivers
-    idle_drivers = [driver for driver in drivers
-                    if driver.status == "online" and driver.destination_zone is None]
-
-    if not idle_drivers:
-        return [ActionBatch(actions=[], total_cost=0, time=time)]
-
-    # Limit to top drivers and zones for performance
-    max_drivers = min(len(idle_drivers), 5)  # Limit driver count
-    max_zones_per_driver = min(len(zones), 8)  # Limit zone options per driver
-
-    # Get current zone densities for prioritization
-    current_densities = get_zone_densities_for_time(time) or [0] * len(zones)
-
-    # Pre-calculate driver zone assignments
-    driver_zones = {}
-    for driver in idle_drivers[:max_drivers]:
-        driver_zones[driver.earner_id] = get_driver_zone_optimized(
-            driver.latitude, driver.longitude, zones)
-
-    # Generate promising actions only (top zones by density difference)
-    promising_actions = []
-    for driver in idle_drivers[:max_drivers]:
-        driver_zone = driver_zones[driver.earner_id]
-
-        # Calculate zone priorities based on density deficit
-        zone_priorities = []
-        drivers_in_zones = [0] * len(zones)
-
-        # Count current driver distribution
-        for d in idle_drivers:
-            d_zone = driver_zones.get(d.earner_id)
-            if d_zone is not None and d_zone < len(drivers_in_zones):
-                drivers_in_zones[d_zone] += 1
-
-        for zone_id in range(len(zones)):
-            if zone_id != driver_zone:
-                # Safely get density, default to 1 if index out of range
-                zone_density = current_densities[zone_id] if zone_id < len(
-                    current_densities) else 1
-                density_deficit = max(
-                    0, zone_density - drivers_in_zones[zone_id])
-                if density_deficit > 0:  # Only consider zones with demand
-                    cost = zone_distance_cache.get(
-                        (driver_zone, zone_id), 3600)
-                    priority = density_deficit / \
-                        max(cost / 3600, 0.1)  # Benefit/cost ratio
-                    zone_priorities.append((zone_id, priority, cost))
-
-        # Sort by priority and take top zones
-        zone_priorities.sort(key=lambda x: x[1], reverse=True)
-
-        for zone_id, priority, cost in zone_priorities[:max_zones_per_driver]:
-            action = Action(
-                driver_id=driver.earner_id,
-                from_zone=driver_zone,
-                to_zone=zone_id,
-                cost=cost,
-                time=time
-            )
-            promising_actions.append(action)
-
-        # If no promising actions found, add some random actions as fallback
-        if not zone_priorities and driver_zone is not None:
-            for zone_id in range(min(3, len(zones))):  # Try first 3 zones as fallback
-                if zone_id != driver_zone:
-                    cost = zone_distance_cache.get(
-                        (driver_zone, zone_id), 3600)
-                    action = Action(
-                        driver_id=driver.earner_id,
-                        from_zone=driver_zone,
-                        to_zone=zone_id,
-                        cost=cost,
-                        time=time
-                    )
-                    promising_actions.append(action)
-
-    # Generate action batches with limited combinations
-    # Do nothing option
-    action_batches = [ActionBatch(actions=[], total_cost=0, time=time)]
-
-    # Single driver actions
-    for action in promising_actions:
-        batch = ActionBatch(
-            actions=[action], total_cost=action.cost, time=time)
-        action_batches.append(batch)
-
-    # Limited multi-driver actions (only if beneficial)
-    if max_simultaneous_actions > 1 and len(promising_actions) > 1:
-        # Limit total combinations
-        max_combinations = min(20, len(promising_actions))
-        sorted_actions = sorted(promising_actions, key=lambda a: a.cost)[
-            :max_combinations]
-
-        # Max 3 simultaneous
-        for num_actions in range(2, min(max_simultaneous_actions + 1, 4)):
-            combo_count = 0
-            for action_combo in combinations(sorted_actions, num_actions):
-                if combo_count >= 10:  # Limit combinations per size
-                    break
-
-                driver_ids = [action.driver_id for action in action_combo]
-                if len(driver_ids) == len(set(driver_ids)):  # No duplicates
-                    total_cost = sum(action.cost for action in action_combo)
-                    batch = ActionBatch(
-                        actions=list(action_combo),
-                        total_cost=total_cost,
-                        time=time
-                    )
-                    action_batches.append(batch)
-                    combo_count += 1
-
-    return action_batches[:50]  # Limit total action batches
-
-
-def eval_state(zones, drivers, time, timeframe_count: int = 3) -> float:
-    # Timeframe count is how many 10-minute intervals to look ahead for density
-    # (default 3 = 30 minutes)
-    score = 0
-    drivers_in_zones = [0 for _ in range(len(zones))]
-    for driver in drivers:
-        if driver.status == "online" and driver.destination_zone is None:
-            # Driver is idle, count them in the zone
-            current_driver_zone = get_driver_zone_optimized(
-                driver.latitude, driver.longitude, zones)
-            if current_driver_zone is not None:
-                drivers_in_zones[current_driver_zone] += 1
-
-    # Get density for current weekday/time and next few intervals
-    zone_density = []
-    for i in range(timeframe_count):
-        densities = get_zone_densities_for_time(
-            time + timedelta(minutes=i*10))
-        if densities:
-            if not zone_density:
-                zone_density = densities
-            else:
-                # Sum densities over the timeframes
-                for j in range(len(densities)):
-                    try:
-                        zone_density[j] += densities[j]
-                    except IndexError:
-                        # If densities list is shorter than expected, skip
-                        pass
-
-    for zone_id, driver_count in enumerate(drivers_in_zones):
-        # We check the EV for each zone and compare with driver count
-        # EV = expected value = zone density[zone_id]
-        # If driver count == EV, score += driver count
-        # If driver count > EV, we have oversupply, score += driver count,
-        # but above 130% of EV we start penalizing quadratically
-        # If driver count < EV, we have undersupply, we penalize this quadratically
-        try:
-            current_zone_density = zone_density[zone_id]
-        except IndexError:
-            current_zone_density = 0
-
-        if driver_count == current_zone_density:
-            score += driver_count * 2 + 1
-        elif driver_count > current_zone_density:
-            score += driver_count
-            if driver_count > 2 * current_zone_density:
-                score -= (driver_count - 2 * current_zone_density)
-        else:  # driver_count < current_zone_density
-            score -= (current_zone_density - driver_count)
-
-    # logger.info(f"Evaluated state at time {time}, score: {score}")
-    return score
-
-
-def get_state_hash_optimized(game_state: GameState) -> str:
-    """Generate optimized hash for game state"""
-    # Create a tuple of sorted (driver_id, destination_zone) pairs
-    sorted_assignments = tuple(sorted(game_state.driver_assignments.items()))
-    # Create hash from assignments and time
-    hash_input = f"{sorted_assignments}:{game_state.time}"
-    return hashlib.md5(hash_input.encode()).hexdigest()
-
-
-def get_state_hash(drivers, time):
-    """Legacy hash function for compatibility"""
-    state_data = []
-    for driver in drivers:
-        # logger.info(
-        #     f"Driver {driver.earner_id}:")
-        state_data.append({
-            'id': driver.earner_id,
-            'status': driver.status,
-            'destination_zone': getattr(driver, 'destination_zone', None)
-        })
-
-    state_data.sort(key=lambda x: x['id'])
-    state_str = json.dumps(state_data, sort_keys=True)
-    state_str += f":{time}"
-    return hashlib.md5(state_str.encode()).hexdigest()
-
-
-# Memoization cache for SSS results
-sss_memo_cache = {}
-
-
-def create_driver_state_key(drivers):
-    """Create lightweight state key for memoization"""
-    return tuple(sorted([
-        (d.earner_id, d.status, getattr(d, 'destination_zone', None))
-        for d in drivers
-    ]))
-
-
-def sss_function_optimized(zones, drivers, max_depth, depth, cost, time, visited_states=None, max_simultaneous_actions=3, alpha=-sys.maxsize, beta=sys.maxsize):
-    """Optimized SSS with memoization, alpha-beta pruning, and early termination"""
-    global progress_counter, sss_memo_cache
-    progress_counter += 1
-
-    if progress_counter % 1000 == 0:  # Reduced logging frequency
-        logger.info(f"Progress: {progress_counter}, Depth: {depth}")
-
-    if visited_states is None:
-        visited_states = set()
-
-    # Create memoization key
-    driver_state_key = create_driver_state_key(drivers)
-    memo_key = (driver_state_key, depth, time.hour,
-                time.minute // 10)  # 10-min granularity
-
-    if memo_key in sss_memo_cache:
-        return sss_memo_cache[memo_key]
-
-    # Generate state hash for cycle detection (simplified)
-    state_hash = get_state_hash_optimized(GameState(
-        {d.earner_id: getattr(d, 'destination_zone', None) for d in drivers}, time))
-
-    if state_hash in visited_states:
-        return -sys.maxsize - 1, 0, []
-
-    visited_states.add(state_hash)
-
-    if depth == max_depth:
-        # Reduced timeframe for speed
-        score = eval_state(zones, drivers, time, 2)
-        result = (score, cost, [])
-        sss_memo_cache[memo_key] = result
-        return result
-
-    best_score = -sys.maxsize - 1
-    best_cost = sys.maxsize
-    best_action_batches = []
-
-    # Use optimized action generation
-    action_batches = generate_action_combinations_optimized(
-        drivers, zones, time, max_simultaneous_actions)
-
-    # Only "do nothing" action
-    if not action_batches or len(action_batches) == 1:
-        result = sss_function_optimized(zones, drivers, max_depth, depth + 1,
-                                        cost, time + timedelta(minutes=3), visited_states.copy(), max_simultaneous_actions, alpha, beta)
-        sss_memo_cache[memo_key] = result
-        return result
-
-    # Sort action batches by potential (heuristic: prioritize low-cost, high-demand moves)
-    def action_batch_priority(batch):
-        if not batch.actions:
-            return 0
-        # Simple heuristic: prefer lower cost actions to high-demand zones
-        return -batch.total_cost / max(len(batch.actions), 1)
-
-    action_batches.sort(key=action_batch_priority, reverse=True)
-
-    for i, action_batch in enumerate(action_batches):
-        # Early termination: only explore top N action batches
-        if i >= 15:  # Limit exploration
-            break
-
-        # Create lightweight driver state updates instead of deep copy
-        driver_updates = {}
-        for action in action_batch.actions:
-            driver_updates[action.driver_id] = action.to_zone
-
-        # Apply updates to create new state
-        new_drivers = []
-        for driver in drivers:
-            new_driver = copy.copy(driver)  # Shallow copy instead of deep copy
-            if driver.earner_id in driver_updates:
-                new_driver.destination_zone = driver_updates[driver.earner_id]
-            new_drivers.append(new_driver)
-
-        # Recursive call with alpha-beta pruning
-        recursive_score, recursive_cost, recursive_batches = sss_function_optimized(
-            zones, new_drivers, max_depth, depth + 1,
-            action_batch.total_cost, time + timedelta(minutes=3), visited_states.copy(), max_simultaneous_actions, alpha, beta)
-
-        total_cost = action_batch.total_cost + recursive_cost
-        adjusted_score = recursive_score - total_cost / 5000
-
-        if adjusted_score > best_score or (adjusted_score == best_score and total_cost < best_cost):
-            best_score = adjusted_score
-            best_cost = total_cost
-            best_action_batches = [action_batch] + recursive_batches
-
-            # Update alpha for pruning
-            alpha = max(alpha, adjusted_score)
-
-        # Alpha-beta pruning
-        if beta <= alpha:
-            break  # Prune remaining branches
-
-    result = (best_score, best_cost, best_action_batches)
-    sss_memo_cache[memo_key] = result
-    return result
-
-
-@router.post("/state-space-search")
-async def state_space_search(city_id: int, max_depth: int, custom_time: datetime = None, max_simultaneous_actions: int = 3):
-    logger.info(
-        f"Received state space search request for city_id={city_id}, max_depth={max_depth}")
-
-    city = await Cities.filter(city_id=city_id).first()
-    if not city:
-        return {"error": "City not found"}
-
-    logger.info(
-        f"Starting state space search in city {city.name} with max depth {max_depth}")
-
-    zones = city.zones
-
-    densities_initialized = city.zone_densities
-
-    # Initialize zone density cache at the start of SSS request
-    initialize_zone_density_cache(densities_initialized, True)
-
-    # Pre-compute zone centroids for performance optimization
-    precompute_zone_centroids(zones)
-
-    drivers = await Earners.filter(home_city_id=city_id, earner_type="driver").all()
-
-    cost = 0
-
-    global progress_counter
-    progress_counter = 0
-
-    # current time of day
-    time = datetime.now()
-
-    driver_count = 0
-    for driver in drivers[:10]:
-        if driver.status == "online" and driver.destination_zone is None:
-            driver_count += 1
-        if driver.latitude == 0 or driver.longitude == 0:
-            # get random location within a random zone
-            random_zone = random.choice(list(zones))
-            random_shape = random.choice(random_zone)
-            random_point = Polygon(random_shape["shell"]).centroid
-            driver.latitude = random_point.y
-            driver.longitude = random_point.x
-
-            # update driver location in db
-            await Earners.filter(earner_id=driver.earner_id).update(
-                latitude=driver.latitude, longitude=driver.longitude)
-
-    logger.info(f"Driver count: {driver_count}")
-
-    logger.info(f"Starting SSS at time: {time}")
-
-    if custom_time:
-        time = custom_time
-        logger.info(f"Using custom time: {time}")
-
-    # Update driver states from trips before starting SSS
-    trip_update_result = await update_driver_states_from_trips(time)
-    logger.info(f"Trip update result: {trip_update_result}")
-
-    # Pre-compute zone-to-zone travel times for performance optimization
-    logger.info("Pre-computing zone distances...")
-    precompute_zone_distances(zones, time)
-
-    # Clear memoization cache for new search
-    global sss_memo_cache
-    sss_memo_cache.clear()
-
-    score, cost, optimal_action_batches = sss_function_optimized(
-        zones, copy.deepcopy(drivers[:10]), max_depth, 0, cost, time, None, max_simultaneous_actions)
-
-    # Convert action batches to serializable format
+def serialize_action_batches(action_batches):
+    """Convert action batches to the JSON shape shared by the planning endpoints"""
     batches_data = []
     all_actions = []
 
-    for batch in optimal_action_batches:
+    for batch in action_batches:
         batch_actions = []
         for action in batch.actions:
             action_data = {
@@ -615,6 +56,73 @@ async def state_space_search(city_id: int, max_depth: int, custom_time: datetime
             "action_count": len(batch_actions)
         })
 
+    return batches_data, all_actions
+
+
+@router.post("/state-space-search")
+async def state_space_search(city_id: int, max_depth: Optional[int] = None, custom_time: datetime = None, max_simultaneous_actions: int = 3,
+                             max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES, max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES,
+                             deadline_ms: Optional[int] = None, workers: int = 1, planner: str = SSSPlanner.name,
+                             max_nodes: Optional[int] = None, beam_width: int = DEFAULT_BEAM_WIDTH,
+                             max_children: int = ActionLimits.max_children, max_batches: int = ActionLimits.max_batches):
+    """
+    State space search over the city's fleet.
+
+    With deadline_ms (or max_nodes), runs anytime iterative deepening (up to
+    max_depth, or MAX_ITERATIVE_DEPTH) and returns the deepest plan
+    completed within deadline_ms of starting the plan (or within max_nodes
+    explored states).
+
+    Plans are searched once per city, 3-minute tick, fleet snapshot version
+    and settings, and shared by all callers; a request that finds its plan
+    being searched waits for it (its own deadline isn't restarted).
+
+    With workers > 1, the root's children are searched in parallel worker
+    processes; the plan is the same as the serial search's.
+
+    planner picks the search engine: "sss" (depth-first alpha-beta),
+    "beam" (beam_width states per step) or "mcts" (Monte Carlo tree search,
+    runs until the deadline or node budget). max_children and max_batches
+    cap the branching factor of every engine.
+    """
+    request_start = timing.monotonic()
+    logger.info(
+        f"Received state space search request for city_id={city_id}, max_depth={max_depth}, deadline_ms={deadline_ms}")
+
+    if max_depth is None and deadline_ms is None and max_nodes is None:
+        return {"error": "Either max_depth, deadline_ms or max_nodes is required"}
+
+    if planner not in PLANNERS:
+        return {"error": f"Unknown planner: {planner}"}
+
+    time = custom_time or datetime.now()
+    logger.info(f"Starting state space search at time: {time}")
+
+    # Shared per-tick plan: concurrent identical requests for the city wait
+    # for one search, and the fleet is the tick's snapshot
+    plan, cached = await city_plan_cache.get(city_id, time, PlanSettings(
+        max_depth=max_depth or MAX_ITERATIVE_DEPTH,
+        max_simultaneous_actions=max_simultaneous_actions,
+        max_memo_entries=max_memo_entries,
+        max_memo_bytes=max_memo_bytes,
+        workers=workers,
+        planner=planner,
+        max_nodes=max_nodes,
+        beam_width=beam_width,
+        max_children=max_children,
+        max_batches=max_batches,
+        deadline_ms=deadline_ms,
+    ))
+    if plan is None:
+        return {"error": "City not found"}
+
+    result = plan.result
+    score, cost, optimal_action_batches = result.score, result.cost, result.optimal_action_batches
+    depth_reached = result.depth_reached
+
+    # Convert action batches to serializable format
+    batches_data, all_actions = serialize_action_batches(optimal_action_batches)
+
     # Calculate metrics for RL training
     total_travel_cost = sum(action.cost for action in all_actions)
     unique_drivers = len(set(action.driver_id for action in all_actions))
@@ -631,97 +139,74 @@ async def state_space_search(city_id: int, max_depth: int, custom_time: datetime
         "unique_drivers_moved": unique_drivers,
         "avg_cost_per_action": total_travel_cost / total_actions if total_actions > 0 else 0,
         "avg_actions_per_time_step": total_actions / len(batches_data) if batches_data else 0,
-        "search_depth": max_depth,
-        "explored_states": progress_counter
+        "planner": planner,
+        "search_depth": depth_reached,
+        "deadline_ms": deadline_ms,
+        "elapsed_ms": round((timing.monotonic() - request_start) * 1000),
+        "explored_states": result.explored_states,
+        "memo_stats": result.memo_stats,
+        "leaf_cache_hit_rate": result.leaf_cache_stats.get("hit_rate", 0),
+        "leaf_cache_stats": result.leaf_cache_stats,
+        "plan_cache": plan_cache_info(plan, cached),
     }
 
 
 @router.post("/state-space-search-optimized")
-async def state_space_search_optimized_endpoint(city_id: int, max_depth: int = 3, custom_time: datetime = None, max_simultaneous_actions: int = 2):
+async def state_space_search_optimized_endpoint(city_id: int, max_depth: int = 3, custom_time: datetime = None, max_simultaneous_actions: int = 2,
+                                                max_memo_entries: int = DEFAULT_MEMO_MAX_ENTRIES, max_memo_bytes: int = DEFAULT_MEMO_MAX_BYTES,
+                                                workers: int = 1, planner: str = SSSPlanner.name, max_nodes: Optional[int] = None,
+                                                beam_width: int = DEFAULT_BEAM_WIDTH, max_children: int = ActionLimits.max_children,
+                                                max_batches: int = ActionLimits.max_batches, warm_start: bool = True):
     """
     Optimized state space search endpoint with performance improvements:
     - Limited driver and zone combinations
-    - Memoization for repeated states
+    - Bounded, request-scoped memoization for repeated states
     - Alpha-beta pruning
-    - Shallow copying instead of deep copying
+    - Array-backed fleet state with copy-on-write child states
     - Intelligent action prioritization
+    - Search runs in a worker process, off the event loop
+    - Optional parallel root splitting across `workers` processes
+    - Pluggable engines (`planner`: sss, beam or mcts) with a node budget
+    - Warm-started replans (`warm_start`): the city's previous leaf cache and
+      move ordering are reused, and an unchanged fleet at the same time gets
+      the previous plan back
+    - Plans are searched once per city, 3-minute tick, fleet snapshot version
+      and settings, and shared by all callers (see /city-plan/.../drivers/...)
     """
     logger.info(
         f"Starting OPTIMIZED SSS for city_id={city_id}, max_depth={max_depth}")
 
-    city = await Cities.filter(city_id=city_id).first()
-    if not city:
-        return {"error": "City not found"}
-
-    zones = city.zones
-    densities_initialized = city.zone_densities
-
-    # Initialize zone density cache
-    initialize_zone_density_cache(densities_initialized, True)
-    precompute_zone_centroids(zones)
-
-    drivers = await Earners.filter(home_city_id=city_id, earner_type="driver").all()
+    if planner not in PLANNERS:
+        return {"error": f"Unknown planner: {planner}"}
 
-    # Limit to fewer drivers for better performance
-    max_drivers_to_consider = len(drivers)
-    selected_drivers = drivers[:max_drivers_to_consider]
-
-    # Initialize driver locations if needed
-    for driver in selected_drivers:
-        if driver.latitude == 0 or driver.longitude == 0:
-            random_zone = random.choice(list(zones))
-            random_shape = random.choice(random_zone)
-            random_point = Polygon(random_shape["shell"]).centroid
-            driver.latitude = random_point.y
-            driver.longitude = random_point.x
-            await Earners.filter(earner_id=driver.earner_id).update(
-                latitude=driver.latitude, longitude=driver.longitude)
-
-    time = custom_time or datetime.now()
-
-    # Update driver states
-    await update_driver_states_from_trips(time)
-
-    # Pre-compute distances
-    precompute_zone_distances(zones, time)
-
-    # Clear and run optimized search
-    global sss_memo_cache, progress_counter
-    sss_memo_cache.clear()
-    progress_counter = 0
-
-    import time as timing
     start_time = timing.time()
 
-    score, cost, optimal_action_batches = sss_function_optimized(
-        zones, selected_drivers, max_depth, 0, 0, time, None, max_simultaneous_actions)
+    # Shared per-tick plan: identical requests in the same tick and fleet
+    # state reuse (or wait for) one search
+    plan, cached = await city_plan_cache.get(city_id, custom_time or datetime.now(), PlanSettings(
+        max_depth=max_depth,
+        max_simultaneous_actions=max_simultaneous_actions,
+        max_memo_entries=max_memo_entries,
+        max_memo_bytes=max_memo_bytes,
+        workers=workers,
+        planner=planner,
+        max_nodes=max_nodes,
+        beam_width=beam_width,
+        max_children=max_children,
+        max_batches=max_batches,
+        warm_start=warm_start,
+    ))
+    if plan is None:
+        return {"error": "City not found"}
+
+    result = plan.result
+    score, cost, optimal_action_batches = result.score, result.cost, result.optimal_action_batches
 
     end_time = timing.time()
     search_duration = end_time - start_time
 
     # Process results
-    batches_data = []
-    all_actions = []
-
-    for batch in optimal_action_batches:
-        batch_actions = []
-        for action in batch.actions:
-            action_data = {
-                "driver_id": action.driver_id,
-                "from_zone": action.from_zone,
-                "to_zone": action.to_zone,
-                "cost": action.cost,
-                "time": action.time.isoformat()
-            }
-            batch_actions.append(action_data)
-            all_actions.append(action)
-
-        batches_data.append({
-            "time_step": batch.time.isoformat(),
-            "actions": batch_actions,
-            "batch_cost": batch.total_cost,
-            "action_count": len(batch_actions)
-        })
+    batches_data, all_actions = serialize_action_batches(optimal_action_batches)
 
     total_travel_cost = sum(action.cost for action in all_actions)
     unique_drivers = len(set(action.driver_id for action in all_actions))
@@ -732,14 +217,15 @@ async def state_space_search_optimized_endpoint(city_id: int, max_depth: int = 3
         "optimization_version": "v2.0",
         "performance_improvements": [
             "Limited driver/zone combinations",
-            "Memoization cache",
+            "Bounded LRU memoization cache",
             "Alpha-beta pruning",
-            "Shallow copying",
+            "Array-backed copy-on-write fleet state",
             "Action prioritization",
+            "Search runs in a process pool off the event loop",
             "Early termination"
         ],
         "search_duration_seconds": round(search_duration, 2),
-        "drivers_considered": len(selected_drivers),
+        "drivers_considered": plan.drivers_considered,
         "cost": cost,
         "score": score,
         "optimal_action_batches": batches_data,
@@ -749,8 +235,122 @@ async def state_space_search_optimized_endpoint(city_id: int, max_depth: int = 3
         "unique_drivers_moved": unique_drivers,
         "avg_cost_per_action": total_travel_cost / total_actions if total_actions > 0 else 0,
         "avg_actions_per_time_step": total_actions / len(batches_data) if batches_data else 0,
-        "search_depth": max_depth,
-        "explored_states": progress_counter,
-        "cache_hits": len(sss_memo_cache),
+        "planner": planner,
+        "search_depth": result.depth_reached,
+        "explored_states": result.explored_states,
+        "cache_hits": result.memo_stats["hits"],
+        "memo_stats": result.memo_stats,
+        "leaf_cache_hit_rate": result.leaf_cache_stats.get("hit_rate", 0),
+        "leaf_cache_stats": result.leaf_cache_stats,
+        "warm_start": result.warm_start,
+        "plan_cache": plan_cache_info(plan, cached),
         "speedup_estimate": "10-50x faster than original"
     }
+
+
+@router.get("/city-plan/{city_id}/drivers/{driver_id}")
+async def driver_plan(city_id: int, driver_id: str, custom_time: datetime = None):
+    """
+    The driver's moves in the city's plan for the current tick
+
+    Reads the shared per-tick plan (searched once per city, tick and fleet
+    state), so polling driver apps don't trigger searches of their own.
+    While the planning scheduler runs, only its precomputed plans are read:
+    until the current tick's plan is ready, the previous one is returned.
+    """
+    plan, cached = await city_plan_cache.get_current(
+        city_id, custom_time or datetime.now(), compute=not planning_scheduler.running)
+    if plan is None:
+        return {"error": "No plan available yet" if planning_scheduler.running else "City not found"}
+
+    batches = plan.result.optimal_action_batches
+    actions = [{
+        "time_step": batches[index].time.isoformat(),
+        "from_zone": action.from_zone,
+        "to_zone": action.to_zone,
+        "cost": action.cost,
+        "time": action.time.isoformat()
+    } for index, action in plan.actions_for_driver(driver_id)]
+
+    return {
+        "city_id": city_id,
+        "driver_id": driver_id,
+        "actions": actions,
+        "next_action": actions[0] if actions else None,
+        "plan_cache": plan_cache_info(plan, cached),
+    }
+
+
+@router.post("/rebalance")
+async def rebalance(city_id: int, custom_time: datetime = None, unit_benefit: float = DEFICIT_BENEFIT_SECONDS):
+    """
+    Rebalance the city's idle fleet with a min-cost flow instead of a search.
+
+    Surplus idle drivers are sent to zones whose expected pickups exceed
+    their idle drivers, minimizing total travel time (zone distances). A
+    move is only made if its travel time is below unit_benefit seconds, the
+    value of filling one unit of deficit. Solved in polynomial time over the
+    whole fleet, so it can move hundreds of drivers per tick; the result is
+    a single batch in the same shape as the state space search's.
+    """
+    logger.info(f"Starting rebalance for city_id={city_id}")
+
+    city = await Cities.filter(city_id=city_id).first()
+    if not city:
+        return {"error": "City not found"}
+
+    zones = await load_city_zones(city_id)
+
+    ctx = PlanningContext.for_city(city, zones)
+    await asyncio.to_thread(precompute_zone_centroids, ctx)
+
+    drivers = await Earners.filter(home_city_id=city_id, earner_type="driver").all()
+
+    await ensure_driver_locations(drivers, ctx)
+
+    time = custom_time or datetime.now()
+
+    # Update driver states
+    apply_fleet_snapshot(drivers, await fleet_tracker.snapshot_at(city_id, time))
+
+    await precompute_zone_distances(ctx, time)
+
+    fleet = build_fleet_state(drivers, ctx)
+
+    def solve():
+        batch = plan_rebalance(ctx, fleet, time, unit_benefit)
+        return batch, eval_state(ctx, fleet, time, 2), projected_score(ctx, fleet, batch, time)
+
+    start_time = timing.time()
+    # The min-cost flow and the scoring are CPU-bound; keep them off the event loop
+    batch, score_before, score = await asyncio.to_thread(solve)
+    optimal_action_batches = [batch] if batch.actions else []
+    search_duration = timing.time() - start_time
+
+    batches_data, all_actions = serialize_action_batches(optimal_action_batches)
+
+    total_travel_cost = sum(action.cost for action in all_actions)
+    unique_drivers = len(set(action.driver_id for action in all_actions))
+    total_actions = len(all_actions)
+
+    return {
+        "message": "Rebalance completed",
+        "search_duration_seconds": round(search_duration, 2),
+        "drivers_considered": len(drivers),
+        "cost": batch.total_cost,
+        "score": score,
+        "score_before": score_before,
+        "optimal_action_batches": batches_data,
+        "total_time_steps": len(batches_data),
+        "total_actions": total_actions,
+        "total_travel_cost": total_travel_cost,
+        "unique_drivers_moved": unique_drivers,
+        "avg_cost_per_action": total_travel_cost / total_actions if total_actions > 0 else 0,
+        "avg_actions_per_time_step": total_actions / len(batches_data) if batches_data else 0,
+    }
+
+
+@router.get("/planning-scheduler")
+async def planning_scheduler_status():
+    """Background planning status: rounds, plan cache stats and per-city outcomes"""
+    return planning_scheduler.status()